@@ -1,27 +1,248 @@
 #!/usr/bin/env python3
+import itertools
+import os
+import re
+
 from doepy import build
+import numpy as np
+import pandas as pd
+
+from analysis import code, fit_gp, fit_quadratic, model_matrix, optimum
+from simulate import load_protocol
 
 ################################################################################
-#                     Design Full factorial experiment                         #
+#                            Design the experiment                             #
 ################################################################################
 
-# Define the final concentrations of each factor for the experiment.
+# Define the final concentrations of each factor for the experiment. The factors are the
+# ones in the factors list of the protocol, and factors not given here keep the final
+# concentrations they have in the protocol.
 Mg_final_conc = [3,5,7,9,11,13,15]
 K_final_conc = [60,75,90,105,120,135,150]
 P_final_conc = [0,1,2,3,4,5,6]
+final_conc = {"Mg-glutamate": Mg_final_conc, "K-glutamate": K_final_conc, "PEG-8000": P_final_conc}
+
+# Design mode:
+# "full"         - full factorial of all concentrations
+# "fractional"   - two-level fractional factorial of the lowest and highest concentrations
+# "box_behnken"  - Box-Behnken design of the lowest, middle and highest concentrations
+# "lhs"          - space-filling Latin hypercube
+# "d_optimal"    - D-optimal design for a quadratic response surface
+# "refine"       - full factorial zoomed in on the optimum predicted from the previous round
+# "bayesian"     - batch of conditions proposed by Bayesian optimisation from the previous round
+design = "full"
+
+# Max. number of wells for the design. One 384-well plate fits 382 combinations
+# next to the internal controls. The two-level designs use a full factorial of the
+# lowest and highest concentrations when it fits, and a note gives the replicates of
+# the protocol that fill the budget when the design is smaller.
+well_budget = 343
+
+# Results of the previous round for the "refine" and "bayesian" designs, as written by
+# python analysis.py plate_map.csv plate1.csv --out results.csv
+results_file = "results.csv"
+
+# Fraction of the range of each factor kept around the optimum in the "refine" design
+zoom = 0.5
+
+# Weight of the uncertainty in the upper confidence bound of the "bayesian" design.
+# Higher values explore more, lower values test closer to the predicted optimum.
+exploration = 2
 
-# Note: copy these to update line 20-22 in cfe_buffer_optimization.py.
+# Protocol the design is written to. The final concentrations of its factors are set to
+# the concentrations the design uses.
+protocol_file = "cfe_buffer_optimization.py"
 
 ################################################################################
 
-# Build a full factorial experiment using the specified parameters.
-params = {"Mg-glutamate": Mg_final_conc, "K-glutamate": K_final_conc, "PEG-8000":P_final_conc}
-ff = build.full_fact(params).sample(frac=1, random_state=1)
-# Print out the design of experiments.
-print("ff_dict = ")
-print(ff.to_dict()) 
+# Build the experiment of the factors of the protocol.
+protocol_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), protocol_file)
+module = load_protocol(protocol_path)
+params = {factor["name"]: final_conc.get(factor["name"], factor["final_conc"]) for factor in module.factors}
+
+def snap_to_levels(df, params):
+    """Round every value of the design to the nearest final concentration, as only
+    these are prepared in the dilution rows. Duplicate combinations are removed."""
+    for factor, levels in params.items():
+        levels = np.array(sorted(levels), dtype=float)
+        df[factor] = levels[np.abs(df[factor].values[:, None] - levels).argmin(axis=1)]
+    return df.drop_duplicates().reset_index(drop=True)
+
+def full_fact(levels):
+    """Full factorial of the levels of every factor, with the first factor varying fastest
+    as in build.full_fact, which stores the levels as float32 and loses levels that are
+    not whole numbers."""
+    rows = [combination[::-1] for combination in itertools.product(*list(levels.values())[::-1])]
+    return pd.DataFrame(rows, columns=list(levels), dtype=float)
+
+def full_factorial(params, well_budget):
+    """Full factorial design of all concentrations."""
+    return full_fact(params)
+
+def fractional_factorial(params, well_budget):
+    """Two-level fractional factorial design of the lowest and highest concentrations, or
+    the full two-level factorial when it fits in the well budget."""
+    levels = {k: [min(v), max(v)] for k, v in params.items()}
+    if 2 ** len(levels) <= well_budget:
+        return full_fact(levels)
+    return snap_to_levels(build.frac_fact_res(levels), params)
+
+def box_behnken(params, well_budget):
+    """Box-Behnken design of the lowest, middle and highest concentrations."""
+    levels = {k: [min(v), sorted(v)[len(v)//2], max(v)] for k, v in params.items()}
+    return snap_to_levels(build.box_behnken(levels), params)
+
+def latin_hypercube(params, well_budget):
+    """Space-filling Latin hypercube with one sample per well in the budget."""
+    ranges = {k: [min(v), max(v)] for k, v in params.items()}
+    return snap_to_levels(build.space_filling_lhs(ranges, num_samples=well_budget), params)
+
+def d_optimal(params, well_budget, passes=10, seed=1):
+    """D-optimal design for a quadratic response surface, found by coordinate exchange.
+    Each run is changed one factor at a time to the concentration that maximises
+    det(X'X) until no change improves the design."""
+    levels = [np.array(sorted(v), dtype=float) for v in params.values()]
+    coded_levels = [2 * (l - l.min()) / (l.max() - l.min()) - 1 if l.max() > l.min() else l * 0 for l in levels]
+    rng = np.random.default_rng(seed)
+    runs = np.column_stack([rng.integers(len(l), size=well_budget) for l in levels])
+    if model_matrix(np.zeros((1, len(levels)))).shape[1] > well_budget:
+        raise ValueError("Error: Well budget is too small to fit a quadratic model of {} factors.".format(len(levels)))
+
+    def logdet(runs):
+        X = model_matrix(np.column_stack([coded_levels[i][runs[:, i]] for i in range(len(levels))]))
+        return np.linalg.slogdet(X.T @ X + 1e-9 * np.eye(X.shape[1]))[1]
+
+    best = logdet(runs)
+    for _ in range(passes):
+        improved = False
+        for run in range(well_budget):
+            for i in range(len(levels)):
+                current = runs[run, i]
+                for level in range(len(levels[i])):
+                    if level == current:
+                        continue
+                    runs[run, i] = level
+                    value = logdet(runs)
+                    if value > best + 1e-9:
+                        best, current, improved = value, level, True
+                runs[run, i] = current
+        if not improved:
+            break
+    return pd.DataFrame({factor: levels[i][runs[:, i]] for i, factor in enumerate(params)})
+
+def read_results(params):
+    """Concentrations and mean response of the conditions of the previous round, and the
+    range of the concentrations tested in it."""
+    results = pd.read_csv(results_file)
+    concentrations = results[list(params)].to_numpy(dtype=float)
+    return concentrations, results["mean"].to_numpy(dtype=float), concentrations.min(axis=0), concentrations.max(axis=0)
+
+def refine(params, well_budget):
+    """Full factorial zoomed in on the optimum of a quadratic response surface fitted to
+    the results of the previous round. The range of each factor is shrunk by zoom around
+    the optimum, and gets as many levels as the well budget allows (max. 11)."""
+    (concentrations, response, lower, upper) = read_results(params)
+    (predict, r2) = fit_quadratic(code(concentrations, lower, upper), response)
+    (best, _) = optimum(predict, lower, upper)
+    nlevels = min(11, int(round(well_budget ** (1 / len(params)), 9)))
+    if nlevels < 2:
+        raise ValueError("Error: Well budget is too small for a full factorial of {} factors with 2 levels.".format(len(params)))
+    levels = {}
+    for factor, opt, low, high in zip(params, best, lower, upper):
+        span = zoom * (high - low)
+        start = min(max(opt - span / 2, low), high - span)
+        levels[factor] = sorted(set(np.round(np.linspace(start, start + span, nlevels), 2).tolist()))
+    return full_fact(levels)
+
+def bayesian(params, well_budget):
+    """Batch of conditions proposed by Bayesian optimisation from the results of the previous
+    round. A Gaussian process is fitted to the results, and conditions of the full factorial
+    of the concentrations are added one at a time by the upper confidence bound, with the
+    uncertainty conditioned on the conditions already in the batch. Tested conditions can
+    be proposed again as replicates."""
+    (concentrations, response, lower, upper) = read_results(params)
+    (predict, r2) = fit_gp(code(concentrations, lower, upper), response)
+    candidates = full_fact(params)
+    x = code(candidates.to_numpy(dtype=float), lower, upper)
+    batch = []
+    for _ in range(min(well_budget, len(candidates))):
+        (mean, std) = predict(x, std=True, pending=x[batch] if batch else None)
+        ucb = mean + exploration * std
+        ucb[batch] = -np.inf
+        batch.append(int(np.argmax(ucb)))
+    return candidates.iloc[batch].reset_index(drop=True)
+
+def number(c):
+    return str(int(c)) if c == int(c) else str(c)
+
+def write_design(ff, path):
+    """Write the design and the final concentrations it uses into the protocol, replacing
+    the design block and the final concentration variables."""
+    with open(path) as f:
+        text = f.read()
+    lines = ["condition," + ",".join(params)]
+    lines += ["{},{}".format(i, ",".join(number(c) for c in row)) for i, row in zip(ff.index, ff[list(params)].to_numpy(dtype=float))]
+    (text, found) = re.subn(r'^design = """\n.*?^"""$', lambda m: 'design = """\n{}\n"""'.format("\n".join(lines)), text, count=1, flags=re.M | re.S)
+    if not found:
+        raise ValueError("Error: {} has no design block to write the design to.".format(path))
+    for factor in params:
+        levels = "[{}]".format(",".join(number(c) for c in sorted(set(ff[factor].tolist()))))
+        # The final concentrations are a list in the factors list or a variable set to one
+        match = re.search(r'"name": "{}",[^}}]*?"final_conc": (\[[^\]]*\]|\w+)'.format(re.escape(factor)), text)
+        if not match:
+            raise ValueError("Error: {} has no final concentrations of {} in its factors list.".format(path, factor))
+        if match.group(1).startswith("["):
+            text = text[:match.start(1)] + levels + text[match.end(1):]
+            continue
+        (text, found) = re.subn(r"^{} = \[.*\]$".format(re.escape(match.group(1))), lambda m: "{} = {}".format(match.group(1), levels), text, count=1, flags=re.M)
+        if not found:
+            raise ValueError("Error: {} has no variable {} for the final concentrations of {}.".format(path, match.group(1), factor))
+    with open(path, "w") as f:
+        f.write(text)
+
+def check_dilutions(ff):
+    """Plan the dilutions of every factor for the wells of each concentration in the design
+    with plan_dilution() of the protocol, so that a design which repeats a concentration in
+    more wells than its dilutions or stock hold fails before it is written."""
+    max_vol = 300 if module.pipette_mode == "single" else 20
+    for factor in module.factors:
+        counts = {c: int(n) * module.replicates for c, n in ff[factor["name"]].value_counts().sort_index().items()}
+        try:
+            plan = module.plan_dilution(dict(factor, final_conc=list(counts)), counts, max_vol, [module.level_volumes(factor, counts)] * len(module.aliquot_slots))
+            needed = module.stock_needed(plan)
+            if needed > factor["stock_vol"] + 1e-6:
+                raise ValueError("Error: The {} dilutions need {:.1f} muL stock, more than stock_vol of {} muL.".format(factor["name"], needed, factor["stock_vol"]))
+        except ValueError as e:
+            raise ValueError("Error: The {} design of {} wells repeats {} {} up to {} times, and {} cannot dilute it: {} Lower well_budget.".format(
+                design, len(ff) * module.replicates, factor["name"], number(max(counts, key=counts.get)), max(counts.values()),
+                protocol_file, str(e).replace("Error: ", "", 1)))
+
+designs = {
+    "full": full_factorial,
+    "fractional": fractional_factorial,
+    "box_behnken": box_behnken,
+    "lhs": latin_hypercube,
+    "d_optimal": d_optimal,
+    "refine": refine,
+    "bayesian": bayesian,
+}
+
+ff = designs[design](params, well_budget)
+if len(ff) > well_budget:
+    raise ValueError("Error: {} design needs {} wells, more than the well budget of {}.".format(design, len(ff), well_budget))
+ff = ff.sample(frac=1, random_state=1)
+check_dilutions(ff)
+
+# Print out the final concentrations used by the design.
+for factor in params:
+    print("{}: {}".format(factor, [int(c) if c == int(c) else c for c in sorted(set(ff[factor].tolist()))]))
 
-# Note: Copy this output to substitute line 29-33 in cfe_buffer_optimization.py.
+# Write the design and its final concentrations into the protocol.
+write_design(ff, protocol_path)
+print("Design of {} conditions written to {}".format(len(ff), protocol_file))
+if 2 * len(ff) <= well_budget:
+    print("Note: The design uses {} of the {} wells in the budget. Set replicates = {} in {} to fill it.".format(
+        len(ff), well_budget, well_budget // len(ff), protocol_file))
 
 # Outcomment the following line to export the DOE as a CSV file.
 #ff.to_csv('DOE.csv')
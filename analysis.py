@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""Analysis of the plate-reader data of a buffer optimization.
+
+The plate-reader exports are joined to the design by the plate map of the protocol,
+the signal of the internal control without DNA is subtracted, and a response
+surface is fitted to the concentrations of the factors. The composition with the
+highest predicted response is reported.
+
+    python simulate.py cfe_buffer_optimization.py --plate-map plate_map.csv
+    python analysis.py plate_map.csv plate1.csv plate1_replicate.csv
+
+Exports of replicate plates are pooled. For designs spread over several plates,
+--slots gives the deck slot each export was read from, and for designs split over
+several robots by shard.py, --robots gives the robot.
+"""
+import argparse
+
+import numpy as np
+import pandas as pd
+
+################################################################################
+#                                   Analysis                                   #
+################################################################################
+
+# Model of the response surface:
+# "quadratic" - quadratic response surface (main effects, interactions and squares)
+# "gp"        - Gaussian process with a squared-exponential kernel
+model = "quadratic"
+
+# Points per factor in the grid the optimum is searched on
+grid_points = 41
+
+# Length scales (coded units) and noise variances (relative to the variance of the
+# response) the Gaussian process is fitted with. The pair with the highest marginal
+# likelihood is used.
+gp_length_scales = np.geomspace(0.2, 4, 10)
+gp_noise = np.geomspace(1e-3, 1, 7)
+
+################################################################################
+
+def read_plate_reader(path):
+    """Read a plate-reader export as a Series of values by well name. Both a list with a
+    well column and a value column, and a grid with rows A-P and columns 1-24 are read."""
+    df = pd.read_csv(path, sep=None, engine="python")
+    if all(str(column).strip().isdigit() for column in df.columns[1:]):
+        grid = df.set_index(df.columns[0]).stack()
+        wells = ["{}{}".format(str(row).strip(), str(column).strip()) for row, column in grid.index]
+        return pd.Series(pd.to_numeric(grid.values), index=wells)
+    well_columns = [column for column in df.columns if str(column).strip().lower() == "well"]
+    if not well_columns:
+        raise ValueError("Error: {} has neither a Well column nor a plate grid.".format(path))
+    values = df.drop(columns=well_columns).select_dtypes("number")
+    if values.empty:
+        raise ValueError("Error: {} has no column of values.".format(path))
+    return pd.Series(values.iloc[:, -1].values, index=df[well_columns[0]].astype(str).str.strip())
+
+def join_plate_map(plate_map, exports):
+    """Join the plate-reader values to the plate map. Exports are (path, slot, robot), where
+    robot is None for a plate map of one robot, and the signal of the internal control
+    without DNA of each export is subtracted.
+    Returns the design wells with a response column and a replicate column."""
+    data = []
+    for replicate, (path, slot, robot) in enumerate(exports):
+        wells = plate_map[plate_map["slot"] == slot].copy()
+        if robot is not None:
+            wells = wells[wells["robot"] == robot]
+        if wells.empty:
+            raise ValueError("Error: The plate map has no wells in slot {}{} of {}.".format(slot, "" if robot is None else " of robot {}".format(robot), path))
+        wells["response"] = read_plate_reader(path).reindex(wells["well"]).values
+        background = wells.loc[wells["control"], "response"].mean()
+        wells["response"] -= 0 if np.isnan(background) else background
+        wells["replicate"] = replicate
+        data.append(wells[wells["condition"].notna() & wells["response"].notna()])
+    return pd.concat(data, ignore_index=True)
+
+def code(values, lower, upper):
+    """Scale concentrations to -1 (lower) to 1 (upper)."""
+    return 2 * (values - lower) / np.where(upper > lower, upper - lower, 1) - 1
+
+def model_matrix(coded):
+    """Model matrix of a quadratic response surface: intercept, main effects,
+    two-factor interactions and squared terms of the coded factors."""
+    k = coded.shape[1]
+    columns = [np.ones(len(coded))] + [coded[:, i] for i in range(k)]
+    columns += [coded[:, i] * coded[:, j] for i in range(k) for j in range(i+1, k)]
+    columns += [coded[:, i]**2 for i in range(k)]
+    return np.column_stack(columns)
+
+def fit_quadratic(coded, y):
+    """Least-squares fit of a quadratic response surface. Returns the predictor and R2."""
+    X = model_matrix(coded)
+    if X.shape[1] > len(np.unique(coded, axis=0)):
+        raise ValueError("Error: {} conditions are too few to fit a quadratic model of {} factors.".format(len(np.unique(coded, axis=0)), coded.shape[1]))
+    beta = np.linalg.lstsq(X, y, rcond=None)[0]
+    r2 = 1 - np.sum((y - X @ beta)**2) / np.sum((y - y.mean())**2)
+    return (lambda coded: model_matrix(coded) @ beta), r2
+
+def sq_dist(a, b):
+    return np.sum(a**2, axis=1)[:, None] + np.sum(b**2, axis=1)[None, :] - 2 * a @ b.T
+
+def fit_gp(coded, y):
+    """Gaussian process fit to the mean response of each condition. The length scale
+    and noise are chosen by the marginal likelihood. Returns the predictor and R2."""
+    (x, inverse) = np.unique(coded, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    counts = np.bincount(inverse)
+    mean = np.bincount(inverse, weights=y) / counts
+    (offset, scale) = (mean.mean(), mean.std() or 1)
+    z = (mean - offset) / scale
+    d2 = sq_dist(x, x)
+    best = None
+    for length_scale in gp_length_scales:
+        K = np.exp(-d2 / (2 * length_scale**2))
+        for noise in gp_noise:
+            try:
+                L = np.linalg.cholesky(K + np.diag(noise / counts))
+            except np.linalg.LinAlgError:
+                continue
+            alpha = np.linalg.solve(L.T, np.linalg.solve(L, z))
+            loglik = -0.5 * z @ alpha - np.sum(np.log(np.diag(L)))
+            if best is None or loglik > best[0]:
+                best = (loglik, length_scale, noise, alpha)
+    (_, length_scale, noise, alpha) = best
+    kernel = lambda a, b: np.exp(-sq_dist(a, b) / (2 * length_scale**2))
+
+    def predict(coded, std=False, pending=None, chunk=10000):
+        """Predicted response, and with std=True also its standard deviation. The standard
+        deviation can be conditioned on pending conditions whose response is not known yet."""
+        mean = np.concatenate([offset + scale * kernel(coded[i:i+chunk], x) @ alpha for i in range(0, len(coded), chunk)])
+        if not std:
+            return mean
+        points = x if pending is None else np.vstack([x, pending])
+        noises = noise / counts if pending is None else np.concatenate([noise / counts, np.full(len(pending), noise)])
+        L = np.linalg.cholesky(kernel(points, points) + np.diag(noises))
+        var = np.concatenate([1 - np.sum(np.linalg.solve(L, kernel(points, coded[i:i+chunk]))**2, axis=0)
+                              for i in range(0, len(coded), chunk)])
+        return mean, scale * np.sqrt(np.maximum(var, 0))
+    r2 = 1 - np.sum((y - predict(coded))**2) / np.sum((y - y.mean())**2)
+    return predict, r2
+
+def optimum(predict, lower, upper):
+    """Composition with the highest predicted response on a grid over the tested range."""
+    axes = [np.linspace(-1, 1, grid_points if high > low else 1) for low, high in zip(lower, upper)]
+    grid = np.stack(np.meshgrid(*axes, indexing="ij"), axis=-1).reshape(-1, len(axes))
+    prediction = predict(grid)
+    best = np.argmax(prediction)
+    return lower + (grid[best] + 1) / 2 * (upper - lower), prediction[best]
+
+def analyse(data, factors, fit):
+    """Fit the response surface of the factors and print the observed and predicted
+    best compositions. Returns the mean response of each condition with the prediction."""
+    concentrations = data[factors].to_numpy(dtype=float)
+    (lower, upper) = (concentrations.min(axis=0), concentrations.max(axis=0))
+    (predict, r2) = fit(code(concentrations, lower, upper), data["response"].to_numpy(dtype=float))
+
+    conditions = data.groupby(factors)["response"].agg(["mean", "std", "count"]).reset_index()
+    conditions["predicted"] = predict(code(conditions[factors].to_numpy(dtype=float), lower, upper))
+    observed = conditions.loc[conditions["mean"].idxmax()]
+    (composition, prediction) = optimum(predict, lower, upper)
+
+    print("{} wells of {} conditions, {} model, R2 = {:.3f}".format(len(data), len(conditions), model, r2))
+    print("{:<16}{:>12}{:>12}".format("Factor", "Observed", "Predicted"))
+    for factor, conc in zip(factors, composition):
+        print("{:<16}{:>12g}{:>12.3g}".format(factor, observed[factor], conc))
+    print("{:<16}{:>12.4g}{:>12.4g}".format("Response", observed["mean"], prediction))
+    return conditions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fit a response surface to the plate-reader data of a buffer optimization.")
+    parser.add_argument("plate_map", help="plate map CSV file written by simulate.py --plate-map")
+    parser.add_argument("exports", nargs="+", help="plate-reader exports (CSV), replicate plates are pooled")
+    parser.add_argument("--slots", nargs="+", type=int, help="deck slot of the plate of each export (default: the first plate)")
+    parser.add_argument("--robots", nargs="+", type=int, help="robot of the plate of each export, for a plate map written by shard.py")
+    parser.add_argument("--model", choices=["quadratic", "gp"], default=model, help="model of the response surface")
+    parser.add_argument("--out", help="write the mean and predicted response of every condition to this CSV file")
+    args = parser.parse_args()
+    model = args.model
+
+    plate_map = pd.read_csv(args.plate_map)
+    if "protocol" in plate_map:
+        plate_map = plate_map[plate_map["protocol"].str.contains("buffer_optimization")]
+    columns = list(plate_map.columns)
+    factors = columns[columns.index("condition") + 1:columns.index("control")]
+    slots = args.slots or [plate_map["slot"].iloc[0]] * len(args.exports)
+    if len(slots) != len(args.exports):
+        raise ValueError("Error: Give a slot for each of the {} plate-reader exports.".format(len(args.exports)))
+    robots = args.robots or [None] * len(args.exports)
+    if len(robots) != len(args.exports) or ("robot" in plate_map and plate_map["robot"].nunique() > 1 and not args.robots):
+        raise ValueError("Error: Give the robot of each of the {} plate-reader exports.".format(len(args.exports)))
+
+    data = join_plate_map(plate_map, list(zip(args.exports, slots, robots)))
+    conditions = analyse(data, factors, fit_gp if model == "gp" else fit_quadratic)
+    if args.out:
+        conditions.to_csv(args.out, index=False)
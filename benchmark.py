@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""Benchmark of the OT-2 protocols over a range of design sizes.
+
+Each case runs run(protocol) of a protocol against the recording context of
+simulate.py and counts aspirations, dispenses, tips picked up, gantry travel, the
+estimated run time, the time of loading the plates with mastermix and DNA, and
+the time from mastermix to DNA in the wells. The results are compared with the stored results in
+benchmark.json, and any metric that got worse is reported as a regression.
+
+    python benchmark.py             # compare with benchmark.json
+    python benchmark.py --update    # store the results in benchmark.json
+"""
+import argparse
+import itertools
+import json
+import math
+import os
+import sys
+
+from simulate import dna_latency, simulate, summarize
+
+################################################################################
+#                                  Benchmarks                                  #
+################################################################################
+
+# Levels of the factors in the buffer optimization. A design with k factors and
+# n levels uses the first n levels of the first k factors.
+factors = [
+    {"name": "Mg-glutamate", "final_conc": [3,5,7,9,11,13,15], "stock_conc": 1000, "stock_well": "B1", "stock_vol": 100,
+     "dil_vol": 30, "dil_factor": 20, "well_vol": 0.5, "control_conc": 3, "viscous": False},
+    {"name": "K-glutamate", "final_conc": [60,75,90,105,120,135,150], "stock_conc": 2000, "stock_well": "B2", "stock_vol": 300,
+     "dil_vol": 50, "dil_factor": 13, "well_vol": 0.75, "control_conc": 60, "viscous": False},
+    {"name": "PEG-8000", "final_conc": [0,1,2,3,4,5,6], "stock_conc": 40, "stock_well": "B3", "stock_vol": 350,
+     "dil_vol": 80, "dil_factor": 6.66, "well_vol": 1.5, "control_conc": 2, "viscous": True},
+    {"name": "Spermidine", "final_conc": [0,0.5,1,1.5,2], "stock_conc": 100, "stock_well": "B4", "stock_vol": 100,
+     "dil_vol": 30, "dil_factor": 20, "well_vol": 0.5, "control_conc": 1, "viscous": False},
+]
+
+# Full-factorial designs of the buffer optimization as (factors, levels)
+buffer_designs = [(3, 3), (3, 4), (3, 5), (3, 6), (3, 7), (4, 4)]
+
+# Designs that are run with the 8-channel pipette (pipette_mode = "multi"). The lysate
+# and buffer are in the 15 mL reservoir wells, so they hold enough for two plates.
+multi_designs = [(3, 7), (4, 5)]
+multi_start_volumes = {"DNA": 400, "Buffer": 3000, "Lysate": 4000, "MilliQ": 2000}
+
+# Designs that are loaded block by block (scheduler = "blocks")
+block_designs = [(3, 7)]
+
+# Numbers of rows (reagents) of the titration curve
+titration_rows = [1, 11, 16]
+
+# Relative increase of a metric that is reported as a regression
+tolerance = 0.01
+
+################################################################################
+
+here = os.path.dirname(os.path.abspath(__file__))
+results_file = os.path.join(here, "benchmark.json")
+
+def full_factorial(k, n):
+    """User inputs of cfe_buffer_optimization.py for a full factorial of k factors with n levels.
+    The dilutions are made large enough for the wells of each level and the control."""
+    design_factors = [dict(factor, final_conc=factor["final_conc"][:n]) for factor in factors[:k]]
+    for factor in design_factors:
+        dil_vol = factor["well_vol"] * (n**(k-1) + 1) + 2
+        factor["dil_vol"] = max(factor["dil_vol"], 10 * math.ceil(dil_vol / 10))
+    runs = list(itertools.product(*[factor["final_conc"] for factor in design_factors]))
+    lines = ["condition," + ",".join(factor["name"] for factor in design_factors)]
+    lines += ["{},{}".format(i, ",".join(str(conc) for conc in run)) for i, run in enumerate(runs)]
+    return {"factors": design_factors, "design": "\n".join(lines), "nsamples": len(runs) + 1, "max_tiprack_refills": 2}
+
+def metrics(protocol):
+    """Metrics of a simulated run that should not increase."""
+    summary = summarize(protocol)
+    total = summary["total"]
+    latency = list(dna_latency(protocol).values())
+    return {
+        "aspirate": total["aspirate"],
+        "dispense": total["dispense"],
+        "tips": total["tips"],
+        "travel_mm": round(total["travel"], 1),
+        "time_s": round(total["time"], 1),
+        "loading_s": round(sum(phase["time"] for name, phase in summary["phases"].items() if name in ("mastermix", "DNA")), 1),
+        "latency_max_s": round(max(latency), 1),
+        "latency_spread_s": round(max(latency) - min(latency), 1),
+    }
+
+def run_benchmarks():
+    results = {}
+    for (k, n) in buffer_designs:
+        protocol = simulate(os.path.join(here, "cfe_buffer_optimization.py"), **full_factorial(k, n))
+        results["buffer_{}x{}".format(k, n)] = metrics(protocol)
+    for (k, n) in multi_designs:
+        protocol = simulate(os.path.join(here, "cfe_buffer_optimization.py"), pipette_mode="multi", start_volumes=multi_start_volumes, **full_factorial(k, n))
+        results["buffer_{}x{}_multi".format(k, n)] = metrics(protocol)
+    for (k, n) in block_designs:
+        protocol = simulate(os.path.join(here, "cfe_buffer_optimization.py"), scheduler="blocks", **full_factorial(k, n))
+        results["buffer_{}x{}_blocks".format(k, n)] = metrics(protocol)
+    for nrows in titration_rows:
+        protocol = simulate(os.path.join(here, "cfe_titration_curve.py"), rows=list("ABCDEFGHIJKLMNOP"[:nrows]))
+        results["titration" if nrows == 1 else "titration_{}rows".format(nrows)] = metrics(protocol)
+    return results
+
+def compare(results, baseline):
+    """Print the change of every metric and return the regressions."""
+    regressions = []
+    print("{:<24}{:<18}{:>12}{:>12}{:>10}".format("Case", "Metric", "Stored", "Now", "Change"))
+    for case, case_metrics in results.items():
+        for metric, value in case_metrics.items():
+            stored = baseline.get(case, {}).get(metric)
+            if stored is None:
+                print("{:<24}{:<18}{:>12}{:>12}{:>10}".format(case, metric, "-", value, "new"))
+                continue
+            change = (value - stored) / stored if stored else 0
+            print("{:<24}{:<18}{:>12}{:>12}{:>+9.1%}".format(case, metric, stored, value, change))
+            if change > tolerance:
+                regressions.append((case, metric, stored, value))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the OT-2 protocols over a range of design sizes.")
+    parser.add_argument("--update", action="store_true", help="store the results in benchmark.json")
+    args = parser.parse_args()
+
+    results = run_benchmarks()
+    if args.update or not os.path.exists(results_file):
+        with open(results_file, "w") as f:
+            json.dump(results, f, indent=1)
+        print("Results stored in {}".format(results_file))
+    else:
+        with open(results_file) as f:
+            regressions = compare(results, json.load(f))
+        for (case, metric, stored, value) in regressions:
+            print("Regression: {} {} increased from {} to {}".format(case, metric, stored, value))
+        sys.exit(1 if regressions else 0)
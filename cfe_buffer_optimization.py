@@ -1,14 +1,17 @@
 from opentrons import protocol_api
 from math import ceil
-import pandas as pd
+import json
+import random
+import time
 
 metadata = {
     'apiLevel': '2.8',
     'protocolName': 'Cell-free expression buffer optimization setup',
     'description': '''This protocol is designed to set up a range of different 
     buffer compositions to optimize the buffer solution for cell-free expression.
-    It involves adding Mg-glutamate, K-glutamate, and PEG-8000 to a premix 
-    solution. A total of 343 combinations can be tested.''',
+    It involves adding factors such as Mg-glutamate, K-glutamate, and PEG-8000 
+    to a premix solution. Any number of factors and concentrations can be tested,
+    spread over as many 384-well plates as needed.''',
     'author': 'Karen Therkelsen (s173684@dtu.dk)',
 }
 
@@ -26,18 +29,894 @@ Mg_stock_conc = int(1000)   # mM
 K_stock_conc = int(2000)    # mM
 P_stock_conc = int(40)      # %
 
-ff_dict = {
-'Mg-glutamate': {306: 13.0, 340: 11.0, 291: 11.0, 102: 11.0, 289: 7.0, 267: 5.0, 125: 15.0, 11: 11.0, 146: 15.0, 229: 13.0, 165: 11.0, 263: 11.0, 287: 3.0, 159: 13.0, 95: 11.0, 67: 11.0, 4: 11.0, 247: 7.0, 65: 7.0, 85: 5.0, 222: 13.0, 211: 5.0, 330: 5.0, 292: 13.0, 91: 3.0, 6: 15.0, 217: 3.0, 169: 5.0, 331: 7.0, 90: 15.0, 117: 13.0, 106: 5.0, 256: 11.0, 138: 13.0, 107: 7.0, 174: 15.0, 132: 15.0, 18: 11.0, 315: 3.0, 92: 5.0, 80: 9.0, 127: 5.0, 123: 11.0, 251: 15.0, 294: 3.0, 236: 13.0, 131: 13.0, 322: 3.0, 197: 5.0, 111: 15.0, 154: 3.0, 189: 3.0, 122: 9.0, 120: 5.0, 328: 15.0, 208: 13.0, 301: 3.0, 73: 9.0, 59: 9.0, 12: 13.0, 273: 3.0, 27: 15.0, 332: 9.0, 342: 15.0, 89: 13.0, 29: 5.0, 58: 7.0, 212: 7.0, 93: 7.0, 150: 9.0, 105: 3.0, 112: 3.0, 162: 5.0, 327: 13.0, 305: 11.0, 283: 9.0, 179: 11.0, 119: 3.0, 14: 3.0, 245: 3.0, 191: 7.0, 261: 7.0, 51: 7.0, 9: 7.0, 242: 11.0, 16: 7.0, 188: 15.0, 0: 3.0, 249: 11.0, 187: 13.0, 62: 15.0, 171: 9.0, 278: 13.0, 234: 9.0, 70: 3.0, 177: 7.0, 204: 5.0, 41: 15.0, 244: 15.0, 206: 9.0, 231: 3.0, 329: 3.0, 161: 3.0, 39: 11.0, 288: 5.0, 78: 5.0, 232: 5.0, 192: 9.0, 324: 7.0, 17: 9.0, 257: 13.0, 224: 3.0, 88: 11.0, 167: 15.0, 272: 15.0, 42: 3.0, 334: 13.0, 172: 11.0, 139: 15.0, 163: 7.0, 186: 11.0, 5: 13.0, 225: 5.0, 175: 3.0, 38: 9.0, 233: 7.0, 180: 13.0, 158: 11.0, 341: 13.0, 147: 3.0, 100: 7.0, 34: 15.0, 110: 13.0, 218: 5.0, 321: 15.0, 19: 13.0, 213: 9.0, 44: 7.0, 314: 15.0, 207: 11.0, 185: 9.0, 108: 9.0, 299: 13.0, 79: 7.0, 325: 9.0, 201: 13.0, 8: 5.0, 285: 13.0, 99: 5.0, 300: 15.0, 293: 15.0, 275: 7.0, 28: 3.0, 31: 9.0, 55: 15.0, 32: 11.0, 219: 7.0, 48: 15.0, 284: 11.0, 227: 9.0, 33: 13.0, 35: 3.0, 260: 5.0, 63: 3.0, 157: 9.0, 128: 7.0, 46: 11.0, 66: 9.0, 274: 5.0, 173: 13.0, 326: 11.0, 336: 3.0, 277: 11.0, 269: 9.0, 168: 3.0, 47: 13.0, 113: 5.0, 268: 7.0, 40: 13.0, 21: 3.0, 101: 9.0, 164: 9.0, 69: 15.0, 53: 11.0, 137: 11.0, 24: 9.0, 304: 9.0, 184: 7.0, 134: 5.0, 270: 11.0, 116: 11.0, 205: 7.0, 142: 7.0, 295: 5.0, 199: 9.0, 316: 5.0, 56: 3.0, 61: 13.0, 271: 13.0, 221: 11.0, 223: 15.0, 84: 3.0, 181: 15.0, 228: 11.0, 114: 7.0, 311: 9.0, 290: 9.0, 323: 5.0, 118: 15.0, 258: 15.0, 170: 7.0, 145: 13.0, 337: 5.0, 298: 11.0, 54: 13.0, 176: 5.0, 307: 15.0, 194: 13.0, 198: 7.0, 214: 11.0, 230: 15.0, 248: 9.0, 182: 3.0, 246: 5.0, 98: 3.0, 339: 9.0, 238: 3.0, 130: 11.0, 97: 15.0, 310: 7.0, 82: 13.0, 250: 13.0, 60: 11.0, 94: 9.0, 193: 11.0, 140: 3.0, 160: 15.0, 148: 5.0, 220: 9.0, 202: 15.0, 152: 13.0, 309: 5.0, 135: 7.0, 81: 11.0, 124: 13.0, 23: 7.0, 10:9.0, 13: 15.0, 96: 13.0, 210: 3.0, 240: 7.0, 57: 5.0, 296: 7.0, 45: 9.0, 319: 11.0, 103: 13.0, 36: 5.0, 308: 3.0, 20: 15.0, 303: 7.0, 75: 13.0, 200: 11.0, 77: 3.0, 338: 7.0, 149: 7.0, 302: 5.0, 2: 7.0, 52: 9.0, 262: 9.0, 253: 5.0, 259: 3.0, 183: 5.0, 151: 11.0, 312: 11.0, 190: 5.0, 74: 11.0, 243: 13.0, 87: 9.0, 239: 5.0, 143: 9.0, 286: 15.0, 266: 3.0, 136: 9.0, 166: 13.0, 83: 15.0, 155: 5.0, 279: 15.0, 126: 3.0, 195: 15.0, 265: 15.0, 318: 9.0, 104: 15.0, 153: 15.0, 282: 7.0,226: 7.0, 25: 11.0, 196: 3.0, 64: 5.0, 15: 5.0, 297: 9.0, 109: 11.0, 26: 13.0, 76: 15.0, 43: 5.0, 280: 3.0, 3: 9.0, 49: 3.0, 333: 11.0, 30: 7.0, 121: 7.0, 115: 9.0, 320: 13.0, 216: 15.0, 264: 13.0, 209: 15.0, 1: 5.0, 313: 13.0, 22: 5.0, 317: 7.0, 7: 3.0, 141: 5.0, 86: 7.0, 241: 9.0, 215: 13.0, 68: 13.0, 50: 5.0, 156: 7.0, 252: 3.0, 254: 7.0, 276: 9.0, 178: 9.0, 281: 5.0, 237: 15.0, 71: 5.0, 129: 9.0, 144: 11.0, 335: 15.0, 133: 3.0, 203: 3.0, 255: 9.0, 72: 7.0, 235: 11.0, 37:7.0}, 
-'K-glutamate': {306: 75.0, 340: 150.0, 291: 150.0, 102: 60.0, 289: 150.0, 267: 105.0, 125: 105.0, 11: 75.0, 146: 150.0, 229: 120.0, 165: 90.0, 263: 90.0, 287: 150.0, 159: 75.0, 95: 150.0, 67: 90.0, 4: 60.0, 247: 60.0, 65: 90.0, 85: 135.0, 222: 105.0, 211: 90.0, 330: 135.0, 292: 150.0, 91: 150.0, 6: 60.0, 217: 105.0, 169: 105.0, 331: 135.0, 90: 135.0, 117: 90.0, 106: 75.0, 256: 75.0, 138: 135.0, 107: 75.0, 174: 105.0, 132: 120.0, 18: 90.0, 315: 105.0, 92: 150.0, 80: 120.0, 127: 120.0, 123: 105.0, 251: 60.0, 294: 60.0, 236: 135.0, 131: 120.0, 322: 120.0, 197: 60.0, 111: 75.0, 154: 75.0, 189: 150.0, 122: 105.0, 120: 105.0, 328: 120.0, 208: 75.0, 301: 75.0, 73: 105.0, 59: 75.0, 12: 75.0, 273: 120.0, 27: 105.0, 332: 135.0, 342: 150.0, 89: 135.0, 29: 120.0, 58: 75.0, 212: 90.0, 93: 150.0, 150: 60.0, 105: 75.0, 112: 90.0, 162: 90.0, 327: 120.0, 305: 75.0, 283: 135.0, 179: 120.0, 119: 105.0, 14: 90.0, 245: 60.0, 191: 150.0, 261: 90.0, 51: 60.0, 9:75.0, 242: 150.0, 16: 90.0, 188: 135.0, 0: 60.0, 249: 60.0, 187: 135.0, 62: 75.0, 171: 105.0, 278: 120.0, 234: 135.0, 70: 105.0, 177: 120.0, 204: 75.0, 41: 135.0, 244: 150.0, 206: 75.0, 231: 135.0, 329: 135.0, 161: 90.0, 39: 135.0, 288: 150.0, 78: 120.0, 232: 135.0, 192: 150.0, 324: 120.0, 17: 90.0, 257: 75.0, 224: 120.0, 88: 135.0, 167: 90.0, 272: 105.0, 42: 150.0, 334: 135.0, 172: 105.0, 139: 135.0, 163: 90.0, 186: 135.0, 5: 60.0, 225: 120.0, 175: 120.0, 38: 135.0, 233: 135.0, 180: 120.0, 158: 75.0, 341: 150.0, 147: 60.0, 100: 60.0, 34: 120.0, 110: 75.0, 218: 105.0, 321: 105.0, 19: 90.0, 213: 90.0, 44: 150.0, 314: 90.0, 207: 75.0, 185: 135.0, 108: 75.0, 299: 60.0, 79: 120.0, 325: 120.0, 201: 60.0, 8: 75.0, 285: 135.0, 99: 60.0, 300: 60.0, 293: 150.0, 275: 120.0, 28: 120.0, 31: 120.0, 55: 60.0, 32: 120.0, 219: 105.0, 48: 150.0, 284: 135.0, 227: 120.0, 33: 120.0, 35: 135.0, 260: 90.0, 63: 90.0, 157: 75.0, 128: 120.0, 46: 150.0, 66: 90.0, 274: 120.0, 173: 105.0, 326: 120.0, 336: 150.0, 277: 120.0, 269: 105.0, 168: 105.0, 47: 150.0, 113: 90.0, 268: 105.0, 40: 135.0, 21: 105.0, 101: 60.0, 164: 90.0, 69: 90.0, 53: 60.0, 137: 135.0, 24: 105.0, 304: 75.0, 184: 135.0, 134: 135.0, 270: 105.0, 116: 90.0, 205: 75.0, 142: 150.0, 295: 60.0, 199: 60.0, 316: 105.0, 56: 75.0, 61: 75.0, 271: 105.0, 221: 105.0, 223: 105.0, 84: 135.0, 181: 120.0, 228: 120.0, 114: 90.0, 311: 90.0, 290: 150.0, 323: 120.0, 118: 90.0, 258: 75.0, 170: 105.0, 145: 150.0, 337: 150.0, 298: 60.0, 54: 60.0, 176: 120.0, 307: 75.0, 194: 150.0, 198: 60.0, 214: 90.0, 230: 120.0, 248: 60.0, 182: 135.0, 246: 60.0, 98: 60.0, 339: 150.0, 238: 150.0, 130: 120.0, 97: 150.0, 310: 90.0, 82: 120.0, 250: 60.0, 60: 75.0, 94: 150.0, 193: 150.0, 140: 150.0, 160: 75.0, 148: 60.0, 220: 105.0, 202: 60.0, 152: 60.0, 309: 90.0, 135: 135.0, 81: 120.0, 124: 105.0, 23: 105.0, 10: 75.0, 13: 75.0, 96: 150.0, 210: 90.0, 240: 150.0, 57: 75.0, 296: 60.0, 45: 150.0, 319: 105.0, 103: 60.0, 36: 135.0, 308: 90.0, 20: 90.0, 303: 75.0, 75: 105.0, 200: 60.0, 77: 120.0, 338: 150.0, 149: 60.0, 302: 75.0, 2: 60.0, 52: 60.0, 262: 90.0, 253: 75.0, 259: 90.0, 183: 135.0, 151: 60.0, 312: 90.0, 190: 150.0, 74:105.0, 243: 150.0, 87: 135.0, 239: 150.0, 143: 150.0, 286: 135.0, 266: 105.0, 136: 135.0, 166: 90.0, 83: 120.0, 155: 75.0, 279: 120.0, 126: 120.0, 195: 150.0, 265: 90.0, 318: 105.0, 104: 60.0, 153: 60.0, 282: 135.0, 226: 120.0, 25: 105.0, 196: 60.0, 64: 90.0, 15: 90.0, 297: 60.0, 109: 75.0, 26: 105.0, 76: 105.0, 43: 150.0, 280: 135.0, 3: 60.0, 49: 60.0, 333: 135.0, 30: 120.0, 121: 105.0, 115: 90.0, 320: 105.0, 216: 90.0, 264: 90.0, 209: 75.0, 1: 60.0, 313: 90.0, 22: 105.0, 317: 105.0, 7: 75.0, 141: 150.0, 86: 135.0, 241: 150.0, 215: 90.0, 68: 90.0, 50: 60.0, 156: 75.0, 252: 75.0, 254: 75.0, 276: 120.0, 178: 120.0, 281: 135.0, 237: 135.0, 71: 105.0, 129: 120.0, 144: 150.0, 335: 135.0, 133: 135.0, 203: 75.0, 255: 75.0, 72: 105.0, 235: 135.0, 37: 135.0}, 
-'PEG-8000': {306: 6.0, 340: 6.0, 291: 5.0, 102: 2.0, 289: 5.0, 267: 5.0, 125:2.0, 11: 0.0, 146: 2.0, 229: 4.0, 165: 3.0, 263: 5.0, 287: 5.0, 159: 3.0, 95: 1.0, 67: 1.0, 4: 0.0, 247: 5.0, 65: 1.0, 85: 1.0, 222: 4.0, 211: 4.0, 330: 6.0, 292: 5.0, 91: 1.0, 6: 0.0, 217: 4.0, 169: 3.0, 331: 6.0, 90: 1.0, 117: 2.0, 106: 2.0, 256: 5.0, 138: 2.0, 107: 2.0, 174: 3.0, 132: 2.0, 18: 0.0, 315: 6.0, 92: 1.0, 80: 1.0, 127: 2.0, 123: 2.0, 251: 5.0, 294: 6.0, 236: 4.0, 131: 2.0, 322: 6.0, 197: 4.0, 111: 2.0, 154: 3.0, 189: 3.0, 122: 2.0, 120: 2.0, 328: 6.0, 208: 4.0, 301: 6.0, 73: 1.0, 59: 1.0, 12: 0.0, 273: 5.0, 27: 0.0, 332: 6.0, 342: 6.0, 89: 1.0, 29: 0.0, 58: 1.0, 212: 4.0, 93: 1.0, 150: 3.0, 105: 2.0, 112: 2.0, 162: 3.0, 327: 6.0, 305: 6.0, 283: 5.0, 179: 3.0, 119: 2.0, 14: 0.0, 245: 5.0, 191: 3.0, 261: 5.0, 51: 1.0, 9: 0.0, 242: 4.0, 16: 0.0, 188: 3.0, 0: 0.0, 249: 5.0, 187: 3.0, 62: 1.0, 171: 3.0, 278: 5.0, 234:4.0, 70: 1.0, 177: 3.0, 204: 4.0, 41: 0.0, 244: 4.0, 206: 4.0, 231: 4.0, 329: 6.0, 161: 3.0, 39: 0.0, 288: 5.0, 78: 1.0, 232: 4.0, 192: 3.0, 324: 6.0, 17: 0.0, 257: 5.0, 224: 4.0, 88: 1.0, 167: 3.0, 272: 5.0, 42: 0.0, 334: 6.0, 172: 3.0, 139: 2.0, 163: 3.0, 186: 3.0, 5: 0.0, 225: 4.0, 175: 3.0, 38: 0.0, 233: 4.0, 180: 3.0, 158: 3.0, 341: 6.0, 147: 3.0, 100:2.0, 34: 0.0, 110: 2.0, 218: 4.0, 321: 6.0, 19: 0.0, 213: 4.0, 44: 0.0, 314: 6.0, 207: 4.0, 185: 3.0, 108: 2.0, 299: 6.0, 79: 1.0, 325: 6.0, 201: 4.0, 8: 0.0, 285: 5.0, 99: 2.0, 300: 6.0, 293: 5.0, 275: 5.0, 28: 0.0, 31: 0.0, 55: 1.0, 32: 0.0, 219: 4.0, 48: 0.0, 284: 5.0, 227: 4.0, 33: 0.0, 35: 0.0, 260: 5.0, 63: 1.0, 157: 3.0, 128: 2.0, 46: 0.0, 66: 1.0, 274: 5.0, 173: 3.0, 326: 6.0, 336: 6.0, 277: 5.0, 269: 5.0, 168: 3.0, 47: 0.0, 113: 2.0, 268: 5.0, 40: 0.0, 21: 0.0, 101:2.0, 164: 3.0, 69: 1.0, 53: 1.0, 137: 2.0, 24: 0.0, 304: 6.0, 184: 3.0, 134: 2.0, 270: 5.0, 116: 2.0, 205: 4.0, 142: 2.0, 295: 6.0, 199: 4.0, 316: 6.0, 56: 1.0, 61: 1.0, 271: 5.0, 221: 4.0, 223: 4.0, 84: 1.0, 181: 3.0, 228: 4.0, 114: 2.0, 311: 6.0, 290: 5.0, 323: 6.0, 118: 2.0, 258: 5.0, 170: 3.0, 145: 2.0, 337: 6.0, 298: 6.0, 54: 1.0, 176: 3.0, 307: 6.0, 194: 3.0, 198: 4.0, 214: 4.0, 230: 4.0, 248: 5.0, 182: 3.0, 246: 5.0, 98: 2.0, 339: 6.0, 238: 4.0, 130: 2.0, 97: 1.0, 310: 6.0, 82: 1.0, 250: 5.0, 60: 1.0, 94: 1.0, 193: 3.0, 140: 2.0, 160: 3.0, 148: 3.0, 220: 4.0, 202: 4.0, 152: 3.0, 309: 6.0, 135: 2.0, 81: 1.0, 124: 2.0, 23: 0.0, 10: 0.0, 13: 0.0, 96: 1.0, 210: 4.0, 240: 4.0, 57: 1.0, 296: 6.0, 45: 0.0, 319: 6.0, 103: 2.0, 36: 0.0, 308: 6.0, 20: 0.0, 303: 6.0, 75: 1.0, 200: 4.0, 77: 1.0, 338: 6.0, 149: 3.0, 302: 6.0, 2: 0.0,52: 1.0, 262: 5.0, 253: 5.0, 259: 5.0, 183: 3.0, 151: 3.0, 312: 6.0, 190: 3.0, 74: 1.0, 243: 4.0, 87: 1.0, 239: 4.0, 143: 2.0, 286: 5.0, 266: 5.0, 136: 2.0, 166: 3.0, 83: 1.0, 155: 3.0, 279: 5.0, 126: 2.0, 195: 3.0, 265: 5.0, 318: 6.0, 104: 2.0, 153: 3.0, 282: 5.0, 226: 4.0, 25: 0.0, 196: 4.0, 64: 1.0, 15: 0.0, 297: 6.0, 109: 2.0, 26: 0.0, 76: 1.0, 43: 0.0,280: 5.0, 3: 0.0, 49: 1.0, 333: 6.0, 30: 0.0, 121: 2.0, 115: 2.0, 320: 6.0, 216: 4.0, 264: 5.0, 209: 4.0, 1: 0.0, 313: 6.0, 22: 0.0, 317: 6.0, 7: 0.0, 141: 2.0, 86: 1.0, 241: 4.0, 215: 4.0, 68: 1.0, 50: 1.0, 156: 3.0, 252: 5.0, 254: 5.0, 276: 5.0, 178: 3.0, 281: 5.0, 237: 4.0, 71: 1.0, 129: 2.0, 144: 2.0, 335: 6.0, 133: 2.0, 203: 4.0, 255: 5.0, 72: 1.0, 235: 4.0, 37: 0.0}
-}
+# Factors to optimize. Each factor gets a row of PCR strips (A, B, C, ...) with
+# its dilutions from column 2 and onwards (max. 8 factors and 11 concentrations).
+# dil_vol:      final volume of the dilutions (muL)
+# dil_factor:   dilution from PCR strip to well
+# well_vol:     volume added to each well (muL)
+# control_conc: concentration in the internal control
+# stock_well:   position of the stock solution in the Eppendorf module
+# stock_vol:    starting volume of the stock solution (muL)
+factors = [
+    {"name": "Mg-glutamate", "final_conc": Mg_final_conc, "stock_conc": Mg_stock_conc, "stock_well": "B1", "stock_vol": 100,
+     "dil_vol": 30, "dil_factor": 20, "well_vol": 0.5, "control_conc": 3, "viscous": False},
+    {"name": "K-glutamate", "final_conc": K_final_conc, "stock_conc": K_stock_conc, "stock_well": "B2", "stock_vol": 300,
+     "dil_vol": 50, "dil_factor": 13, "well_vol": 0.75, "control_conc": 60, "viscous": False},
+    {"name": "PEG-8000", "final_conc": P_final_conc, "stock_conc": P_stock_conc, "stock_well": "B3", "stock_vol": 350,
+     "dil_vol": 80, "dil_factor": 6.66, "well_vol": 1.5, "control_conc": 2, "viscous": True},
+]
+
+# Planning of the dilutions. Stock and MilliQ volumes below min_pipette_vol (muL) are not
+# pipetted. The default is the 0.5 muL dispensed to every well; set it to 1 for the rated
+# accuracy of the P20. When a concentration cannot be made from the stock in dil_vol, the
+# dilutions are made larger, up to max_dil_vol (max. 200 muL, the volume of a PCR strip
+# tube), or from an intermediate stock, diluted by one of intermediate_factors in a free
+# Eppendorf tube of rows C-D. The plan with the fewest transfers is used.
+min_pipette_vol = 0.5
+max_dil_vol = 200
+intermediate_factors = [2, 5, 10, 20, 50, 100]
+
+# Starting volumes (muL) of the reagents in the Eppendorf module, or of the lysate
+# and buffer in the reservoir in multi mode. The protocol analysis fails when the
+# design needs more than these or the stock volumes of the factors. Lysate and buffer
+# that do not fit in one tube are split evenly over the free tubes of rows C-D after
+# the intermediate stocks, as listed in the comments at the start of the run.
+start_volumes = {"DNA": 200, "Buffer": 1500, "Lysate": 2000, "MilliQ": 2000}
+
+# Deck slots for the 384-well plates, used in this order when the design needs more than one plate
+plate_slots = [11, 1, 2, 3, 6, 7]
+
+# Plate layout. Every replicate of the design, with its well of only mastermix and DNA
+# and its internal control, is a block of consecutive wells in plate column order. The
+# first block has the order of the design, which DOE.py randomises, and every further
+# block a random order of its own drawn with layout_seed, so the replicates of a condition
+# are spread over the plate. With empty_edges the outer rows and columns of every plate,
+# where the wells evaporate faster, are left empty. The 8-channel pipette cannot load a
+# column without its outer wells, so in multi mode the P20 then loads the mastermix.
+replicates = 1
+layout_seed = 1
+empty_edges = False
+
+# Pipettes:
+# "single" - P20 and P300 single-channel pipettes
+# "multi"  - P20 single-channel pipette for the dilutions, factors and DNA, and P300
+#            8-channel pipette that mixes the mastermix and loads it to 8 wells of a plate
+#            column per stroke. The lysate and buffer are placed in a 12-well reservoir
+#            instead of the Eppendorf tubes.
+pipette_mode = "single"
+
+# Deck slots for tip racks. When all racks of a pipette are empty the protocol pauses
+# so they can be replaced with full racks, at most max_tiprack_refills times.
+# multi_tip_slots holds 300 muL tip racks for the 8-channel pipette in multi mode.
+p20_tip_slots = [8]
+p300_tip_slots = [9]
+multi_tip_slots = [9]
+max_tiprack_refills = 0
+
+# Order of loading the plates:
+# "sequential" - mastermix to all wells, then the control, the combinations and the DNA
+# "blocks"     - mastermix, control, combinations and DNA block by block of block_columns
+#                plate columns, so the DNA follows shortly after the mastermix. The tips of
+#                the dilutions are returned to their rack and reused in the next block.
+scheduler = "sequential"
+block_columns = 2
+
+# Sharing of the dilutions between the robots of a design split by shard.py:
+# aliquot_slots:  deck slots of PCR strip aluminum blocks that get an aliquot of every
+#                 dilution for another robot. Move each block onto the temperature module
+#                 of its robot right after the dilutions.
+# aliquot_vols:   volumes (muL) of the aliquots of every factor, with a list for each
+#                 aliquot slot of the volume of every final concentration. shard.py sets
+#                 them to what the wells of the other robots need. A factor not given here
+#                 gets aliquots of the volumes this robot needs.
+# make_dilutions: False when the PCR strips on the temperature module are an aliquot of
+#                 the dilutions from another robot, so no dilutions are made.
+aliquot_slots = []
+aliquot_vols = {}
+make_dilutions = True
+
+# Write the calls of the liquid-handling helpers with their wall time as a Chrome trace
+# to this file when the protocol runs on the robot, e.g. "/data/user_storage/trace.json".
+# simulate.py --trace writes the trace of a simulated run.
+trace_file = None
+
+# Design of the experiment, written by DOE.py. Each line is a condition with its key
+# in the design and the final concentration of every factor. The conditions are
+# loaded to the wells in this order, and every concentration must be one of the
+# final concentrations of its factor.
+design = """
+condition,Mg-glutamate,K-glutamate,PEG-8000
+306,13,75,6
+340,11,150,6
+291,11,150,5
+102,11,60,2
+289,7,150,5
+267,5,105,5
+125,15,105,2
+11,11,75,0
+146,15,150,2
+229,13,120,4
+165,11,90,3
+263,11,90,5
+287,3,150,5
+159,13,75,3
+95,11,150,1
+67,11,90,1
+4,11,60,0
+247,7,60,5
+65,7,90,1
+85,5,135,1
+222,13,105,4
+211,5,90,4
+330,5,135,6
+292,13,150,5
+91,3,150,1
+6,15,60,0
+217,3,105,4
+169,5,105,3
+331,7,135,6
+90,15,135,1
+117,13,90,2
+106,5,75,2
+256,11,75,5
+138,13,135,2
+107,7,75,2
+174,15,105,3
+132,15,120,2
+18,11,90,0
+315,3,105,6
+92,5,150,1
+80,9,120,1
+127,5,120,2
+123,11,105,2
+251,15,60,5
+294,3,60,6
+236,13,135,4
+131,13,120,2
+322,3,120,6
+197,5,60,4
+111,15,75,2
+154,3,75,3
+189,3,150,3
+122,9,105,2
+120,5,105,2
+328,15,120,6
+208,13,75,4
+301,3,75,6
+73,9,105,1
+59,9,75,1
+12,13,75,0
+273,3,120,5
+27,15,105,0
+332,9,135,6
+342,15,150,6
+89,13,135,1
+29,5,120,0
+58,7,75,1
+212,7,90,4
+93,7,150,1
+150,9,60,3
+105,3,75,2
+112,3,90,2
+162,5,90,3
+327,13,120,6
+305,11,75,6
+283,9,135,5
+179,11,120,3
+119,3,105,2
+14,3,90,0
+245,3,60,5
+191,7,150,3
+261,7,90,5
+51,7,60,1
+9,7,75,0
+242,11,150,4
+16,7,90,0
+188,15,135,3
+0,3,60,0
+249,11,60,5
+187,13,135,3
+62,15,75,1
+171,9,105,3
+278,13,120,5
+234,9,135,4
+70,3,105,1
+177,7,120,3
+204,5,75,4
+41,15,135,0
+244,15,150,4
+206,9,75,4
+231,3,135,4
+329,3,135,6
+161,3,90,3
+39,11,135,0
+288,5,150,5
+78,5,120,1
+232,5,135,4
+192,9,150,3
+324,7,120,6
+17,9,90,0
+257,13,75,5
+224,3,120,4
+88,11,135,1
+167,15,90,3
+272,15,105,5
+42,3,150,0
+334,13,135,6
+172,11,105,3
+139,15,135,2
+163,7,90,3
+186,11,135,3
+5,13,60,0
+225,5,120,4
+175,3,120,3
+38,9,135,0
+233,7,135,4
+180,13,120,3
+158,11,75,3
+341,13,150,6
+147,3,60,3
+100,7,60,2
+34,15,120,0
+110,13,75,2
+218,5,105,4
+321,15,105,6
+19,13,90,0
+213,9,90,4
+44,7,150,0
+314,15,90,6
+207,11,75,4
+185,9,135,3
+108,9,75,2
+299,13,60,6
+79,7,120,1
+325,9,120,6
+201,13,60,4
+8,5,75,0
+285,13,135,5
+99,5,60,2
+300,15,60,6
+293,15,150,5
+275,7,120,5
+28,3,120,0
+31,9,120,0
+55,15,60,1
+32,11,120,0
+219,7,105,4
+48,15,150,0
+284,11,135,5
+227,9,120,4
+33,13,120,0
+35,3,135,0
+260,5,90,5
+63,3,90,1
+157,9,75,3
+128,7,120,2
+46,11,150,0
+66,9,90,1
+274,5,120,5
+173,13,105,3
+326,11,120,6
+336,3,150,6
+277,11,120,5
+269,9,105,5
+168,3,105,3
+47,13,150,0
+113,5,90,2
+268,7,105,5
+40,13,135,0
+21,3,105,0
+101,9,60,2
+164,9,90,3
+69,15,90,1
+53,11,60,1
+137,11,135,2
+24,9,105,0
+304,9,75,6
+184,7,135,3
+134,5,135,2
+270,11,105,5
+116,11,90,2
+205,7,75,4
+142,7,150,2
+295,5,60,6
+199,9,60,4
+316,5,105,6
+56,3,75,1
+61,13,75,1
+271,13,105,5
+221,11,105,4
+223,15,105,4
+84,3,135,1
+181,15,120,3
+228,11,120,4
+114,7,90,2
+311,9,90,6
+290,9,150,5
+323,5,120,6
+118,15,90,2
+258,15,75,5
+170,7,105,3
+145,13,150,2
+337,5,150,6
+298,11,60,6
+54,13,60,1
+176,5,120,3
+307,15,75,6
+194,13,150,3
+198,7,60,4
+214,11,90,4
+230,15,120,4
+248,9,60,5
+182,3,135,3
+246,5,60,5
+98,3,60,2
+339,9,150,6
+238,3,150,4
+130,11,120,2
+97,15,150,1
+310,7,90,6
+82,13,120,1
+250,13,60,5
+60,11,75,1
+94,9,150,1
+193,11,150,3
+140,3,150,2
+160,15,75,3
+148,5,60,3
+220,9,105,4
+202,15,60,4
+152,13,60,3
+309,5,90,6
+135,7,135,2
+81,11,120,1
+124,13,105,2
+23,7,105,0
+10,9,75,0
+13,15,75,0
+96,13,150,1
+210,3,90,4
+240,7,150,4
+57,5,75,1
+296,7,60,6
+45,9,150,0
+319,11,105,6
+103,13,60,2
+36,5,135,0
+308,3,90,6
+20,15,90,0
+303,7,75,6
+75,13,105,1
+200,11,60,4
+77,3,120,1
+338,7,150,6
+149,7,60,3
+302,5,75,6
+2,7,60,0
+52,9,60,1
+262,9,90,5
+253,5,75,5
+259,3,90,5
+183,5,135,3
+151,11,60,3
+312,11,90,6
+190,5,150,3
+74,11,105,1
+243,13,150,4
+87,9,135,1
+239,5,150,4
+143,9,150,2
+286,15,135,5
+266,3,105,5
+136,9,135,2
+166,13,90,3
+83,15,120,1
+155,5,75,3
+279,15,120,5
+126,3,120,2
+195,15,150,3
+265,15,90,5
+318,9,105,6
+104,15,60,2
+153,15,60,3
+282,7,135,5
+226,7,120,4
+25,11,105,0
+196,3,60,4
+64,5,90,1
+15,5,90,0
+297,9,60,6
+109,11,75,2
+26,13,105,0
+76,15,105,1
+43,5,150,0
+280,3,135,5
+3,9,60,0
+49,3,60,1
+333,11,135,6
+30,7,120,0
+121,7,105,2
+115,9,90,2
+320,13,105,6
+216,15,90,4
+264,13,90,5
+209,15,75,4
+1,5,60,0
+313,13,90,6
+22,5,105,0
+317,7,105,6
+7,3,75,0
+141,5,150,2
+86,7,135,1
+241,9,150,4
+215,13,90,4
+68,13,90,1
+50,5,60,1
+156,7,75,3
+252,3,75,5
+254,7,75,5
+276,9,120,5
+178,9,120,3
+281,5,135,5
+237,15,135,4
+71,5,105,1
+129,9,120,2
+144,11,150,2
+335,15,135,6
+133,3,135,2
+203,3,75,4
+255,9,75,5
+72,7,105,1
+235,11,135,4
+37,7,135,0
+"""
+
+################################################################################
+
+def read_design(text):
+    """Read the design into the keys of the conditions and the concentrations of each
+    factor, both listed in the order of the conditions."""
+    rows = [line.split(",") for line in text.strip().splitlines()]
+    conditions = [int(row[0]) for row in rows[1:]]
+    columns = {name.strip(): [float(row[i]) for row in rows[1:]] for i, name in enumerate(rows[0][1:], 1)}
+    return conditions, columns
+
+# Total number of samples (combinations in the design + 1)
+nsamples = len(read_design(design)[0]) + 1
+
+################################################################################
+#                           Dispense path planning                             #
+################################################################################
+
+def well_position(well_no, nrows=16, ncols=24, pitch=4.5):
+    """Return the (x, y) position in mm of a well number in the column-wise
+    order of plate.wells(). Well numbers beyond the first plate continue on the
+    next plate, which is placed to the right. Defaults match the 384-well plate."""
+    plate_no, well_no = divmod(well_no, nrows * ncols)
+    return (plate_no * ncols + well_no // nrows) * pitch, -(well_no % nrows) * pitch
+
+def path_length(well_no_lst):
+    """Total gantry travel in mm when visiting the wells in the listed order."""
+    length = 0
+    for a, b in zip(well_no_lst, well_no_lst[1:]):
+        (xa, ya), (xb, yb) = well_position(a), well_position(b)
+        length += ((xa - xb)**2 + (ya - yb)**2) ** 0.5
+    return length
+
+def plan_dispense_path(well_no_lst):
+    """Order a list of destination wells by their physical position on the plate.
+    Wells are visited column by column in serpentine order, and the path is then
+    shortened by 2-opt. Only the visiting order changes, not which wells are loaded."""
+    def serpentine(well_no):
+        x, y = well_position(well_no)
+        return x, -y if round(x / 4.5) % 2 == 0 else y
+    path = sorted(well_no_lst, key=serpentine)
+    dist = lambda a, b: path_length([a, b])
+    improved = True
+    while improved:
+        improved = False
+        for i in range(len(path) - 2):
+            for j in range(i + 2, len(path) - 1):
+                # Reverse path[i+1:j+1] if that shortens the tour
+                if dist(path[i], path[j]) + dist(path[i+1], path[j+1]) < dist(path[i], path[i+1]) + dist(path[j], path[j+1]) - 1e-9:
+                    path[i+1:j+1] = reversed(path[i+1:j+1])
+                    improved = True
+    return path
+
+def plan_level_paths(level_wells):
+    """Plan the dispense path of the wells of every factor level with plan_dispense_path().
+    Returns the planned level-to-wells index and the gantry travel between the wells
+    before and after planning."""
+    planned = {}
+    (before, after) = (0, 0)
+    for name, levels in level_wells.items():
+        planned[name] = {}
+        for conc, wells in levels.items():
+            planned[name][conc] = plan_dispense_path(wells)
+            before += path_length(wells)
+            after += path_length(planned[name][conc])
+    return planned, (before, after)
+
+################################################################################
+#                              Multi-dispensing                                #
+################################################################################
+
+def plan_fills(nwells, vol, max_vol=20, disposal_vol=1):
+    """Split a multi-dispense of vol to nwells into as few fills of the pipette as
+    possible. Each fill holds the disposal volume on top of the dispensed volume.
+    Returns the number of wells dispensed to from each fill."""
+    wells_pr_fill = int((max_vol - disposal_vol) / vol + 1e-9)
+    if wells_pr_fill < 1:
+        raise ValueError("Error: {} muL plus {} muL disposal volume exceeds the pipette volume of {} muL.".format(vol, disposal_vol, max_vol))
+    return [min(wells_pr_fill, nwells - i) for i in range(0, nwells, wells_pr_fill)]
+
+def plan_volume_fills(vol_lst, max_vol=20, disposal_vol=1):
+    """Split a multi-dispense of different volumes into as few fills of the pipette as
+    possible, in the order of the volumes. A volume larger than a fill is dispensed in
+    equal parts of up to max_vol, each from a fill of its own without disposal volume.
+    Returns the (index, volume) dispensed from each fill."""
+    capacity = max_vol - disposal_vol
+    fills = [[]]
+    for i, vol in enumerate(vol_lst):
+        parts = ceil(vol / max_vol - 1e-9) if vol > capacity else 1
+        for _ in range(parts):
+            if sum(part for (j, part) in fills[-1]) + vol / parts > capacity + 1e-9:
+                fills.append([])
+            fills[-1].append((i, vol / parts))
+    return [fill for fill in fills if fill]
+
+################################################################################
+#                                Tip tracking                                  #
+################################################################################
+
+class TipTracker:
+    """Hands out tips to a pipette from its tip racks. A tip is picked up for a source
+    liquid, and a tip released with keep() is returned to its rack and reused the next
+    time the same source is pipetted. When all racks are empty the protocol pauses so
+    they can be replaced with full racks. An 8-channel pipette takes a column of tips."""
+
+    def __init__(self, protocol, pipette, racks):
+        self.protocol = protocol
+        self.pipette = pipette
+        if "multi" in pipette.name:
+            self.tips = [tip for rack in racks for tip in rack.rows()[0]]
+        else:
+            self.tips = [tip for rack in racks for tip in rack.wells()]
+        self.next_tip = 0
+        self.kept = {}
+        self.source = None
+        self.tip = None
+        self.used = 0
+
+    def pick_up(self, source):
+        """Pick up the tip kept for source, or else a new tip."""
+        if source in self.kept:
+            self.tip = self.kept.pop(source)
+        else:
+            if self.next_tip == len(self.tips):
+                self.protocol.pause("Replace the empty tip racks of {} with full racks.".format(self.pipette.name))
+                self.pipette.reset_tipracks()
+                self.next_tip = 0
+                self.kept = {}
+            self.tip = self.tips[self.next_tip]
+            self.next_tip += 1
+            self.used += 1
+        self.pipette.pick_up_tip(self.tip)
+        self.source = source
 
+    def keep(self):
+        """Return the tip to its rack for reuse with the same source."""
+        self.pipette.return_tip()
+        self.kept[self.source] = self.tip
+
+    def drop(self):
+        """Drop the tip in the trash."""
+        self.pipette.drop_tip()
+
+class DryRun:
+    """Stand-in for the protocol, a module or a pipette in the dry run of the workflow
+    that counts its tips. Every call is ignored, and no commands are issued."""
+
+    def __getattr__(self, name):
+        return DryRun()
+
+    def __call__(self, *args, **kwargs):
+        return None
+
+    def commands(self):
+        return []
+
+class DryPipette(DryRun):
+    """Stand-in for a pipette in the dry run, which keeps track of the volume in its tip."""
+
+    def __init__(self, pipette):
+        self.name = pipette.name
+        self.max_volume = pipette.max_volume
+        self.current_volume = 0
+
+    def aspirate(self, volume, location=None):
+        self.current_volume += volume
+
+    def dispense(self, volume, location=None):
+        self.current_volume -= volume
+
+    def blow_out(self, location=None):
+        self.current_volume = 0
+
+    def drop_tip(self):
+        self.current_volume = 0
+
+    def return_tip(self):
+        self.current_volume = 0
+
+def half_columns(well_no_lst):
+    """Split well numbers into the half columns of the 384-well plates that an 8-channel
+    pipette loads in one stroke, i.e. every second well of a plate column, and the
+    remaining wells. Half columns are given by the well number of their first well."""
+    well_nos = set(well_no_lst)
+    columns = [well_no for well_no in sorted(well_nos) if well_no % 16 < 2
+               and all(well_no + 2*k in well_nos for k in range(8))]
+    covered = {well_no + 2*k for well_no in columns for k in range(8)}
+    return columns, [well_no for well_no in sorted(well_nos) if well_no not in covered]
+
+################################################################################
+#                               Liquid tracking                                #
+################################################################################
+
+class LiquidTracker:
+    """Keeps track of the liquid in the tubes and reservoir wells that are aspirated
+    from. The liquid height is estimated from the volume as if the well had straight
+    walls, which is at or below the meniscus in tubes with a conical bottom. Aspirations
+    follow the meniscus, immersion mm below it, so they can run at full flow rate.
+    A well that runs dry is recorded, and check() reports the starting volumes needed."""
+
+    def __init__(self, immersion=2, min_height=1):
+        self.immersion = immersion
+        self.min_height = min_height
+        self.volumes = {}
+        self.start = {}
+        self.lowest = {}
+        self.names = {}
+
+    def load(self, well, volume, name):
+        """Set the starting volume of a liquid, which is 0 for liquids prepared by the protocol."""
+        if volume > well.max_volume:
+            raise ValueError("Error: {} muL {} does not fit in {} of {} muL.".format(volume, name, well, well.max_volume))
+        self.volumes[well] = volume
+        self.start[well] = volume
+        self.lowest[well] = volume
+        self.names[well] = name
+
+    def reset(self):
+        """Set every liquid back to its starting volume, after a dry run of the workflow."""
+        self.volumes = dict(self.start)
+        self.lowest = dict(self.start)
+
+    def height(self, well):
+        """Liquid height in mm above the bottom of a well."""
+        depth = well.top().point.z - well.bottom().point.z
+        return max(self.volumes.get(well, 0), 0) * depth / well.max_volume
+
+    def add(self, well, volume, channels=1):
+        """Add a volume to a well. An 8-channel pipette adds it with every channel to a
+        reservoir well, or else to each well of a column of which the first is tracked."""
+        if channels > 1 and len(well.parent.rows()) == 1:
+            volume *= channels
+        self.volumes[well] = self.volumes.get(well, 0) + volume
+        if self.volumes[well] > well.max_volume + 1e-6:
+            raise ValueError("Error: {:.1f} muL {} overflows {} of {} muL.".format(self.volumes[well], self.names.get(well, "liquid"), well, well.max_volume))
+
+    def take(self, well, volume, channels=1):
+        """Remove a volume from a well and return the location to aspirate it from,
+        immersed below the meniscus that is left after the aspiration."""
+        self.add(well, -volume, channels)
+        self.lowest[well] = min(self.lowest.get(well, 0), self.volumes[well])
+        return well.bottom(max(self.min_height, self.height(well) - self.immersion))
+
+    def check(self):
+        """Raise an error listing the liquids that ran out, with the volume missing. Protocol
+        analysis runs the whole protocol, so this stops the run before the robot moves."""
+        short = ["{:.1f} muL more {} in {}".format(-lowest, self.names.get(well, "liquid"), well)
+                 for well, lowest in self.lowest.items() if lowest < -1e-6]
+        if short:
+            raise ValueError("Error: The design needs more liquid than there is: {}.".format(", ".join(short)))
+
+################################################################################
+#                              Dilution planning                               #
+################################################################################
+
+def dilution_volumes(conc, source_conc, final_vol):
+    """Volumes of a source and MilliQ that make final_vol of conc, or None when a volume is
+    below min_pipette_vol. A volume of the source within 1 muL of final_vol is rounded up."""
+    vol = conc * final_vol / source_conc
+    if vol > final_vol or 0 < vol < min_pipette_vol:
+        return None
+    if ceil(vol) == final_vol:
+        return (final_vol, 0)
+    if final_vol - vol < min_pipette_vol:
+        return None
+    return (vol, final_vol - vol)
+
+def strokes(vol, max_vol):
+    """Number of transfers that move vol with a pipette of max_vol."""
+    return ceil(vol / max_vol - 1e-9) if vol > 0 else 0
+
+def level_volumes(factor, counts):
+    """Volume (muL) of every dilution of a factor that a robot needs for the wells of each
+    concentration in counts and the internal controls, with 2 muL dead volume."""
+    return [factor["well_vol"] * (count + replicates) + 2 for count in counts.values()]
+
+def plan_dilution(factor, counts, max_vol, shares=()):
+    """Plan the dilutions of a factor with the fewest transfers. counts maps each concentration
+    of the design to its number of wells, and max_vol is the largest volume moved in one
+    transfer. The dilutions hold enough for their wells and the internal controls, and for
+    the aliquots in shares, each with a volume for every concentration. A control
+    concentration outside the design gets a dilution with enough for the internal controls.
+    Returns the dilution volume, the volumes this robot needs and the aliquots, the volumes
+    of stock, intermediate stock and MilliQ of each dilution, the control dilution
+    (source, volume of the source) and its volume, and the intermediate stock."""
+    (name, stock_conc) = (factor["name"], factor["stock_conc"])
+    dilutions = [(conc, None) for conc in counts]
+    control_vol = max(10, 10 * ceil((factor["well_vol"] * replicates + 2) / 10))
+    if factor["control_conc"] not in counts:
+        dilutions.append((factor["control_conc"], control_vol))
+    too_high = [conc for (conc, vol) in dilutions if conc * factor["dil_factor"] > stock_conc]
+    if too_high:
+        raise ValueError("Error: {} concentrations {} need more than the {} stock concentration. Change {} stock concentration.".format(name, too_high, stock_conc, name))
+    # Each aliquot holds what its robot needs of a concentration, and only the total is rounded up
+    level_vols = level_volumes(factor, counts)
+    required = max([vol + sum(share[j] for share in shares) for j, vol in enumerate(level_vols)], default=0)
+    start = max(factor["dil_vol"], 10 * ceil(required / 10))
+    if start > max_dil_vol:
+        raise ValueError("Error: The {} dilutions need {} muL{}, more than max_dil_vol of {} muL. Use a smaller design, fewer replicates or fewer robots.".format(
+            name, start, " with the aliquots of {} other robots".format(len(shares)) if shares else "", max_dil_vol))
+    best = None
+    made = set()
+    for dil_vol in [start] + list(range(10 * (start // 10 + 1), max_dil_vol + 1, 10)):
+        for ratio in [None] + intermediate_factors:
+            sources = [("stock", stock_conc)] + ([("intermediate", stock_conc / ratio)] if ratio else [])
+            plan = []
+            for (conc, vol) in dilutions:
+                options = [(source, dilution_volumes(conc * factor["dil_factor"], source_conc, vol or dil_vol)) for (source, source_conc) in sources]
+                options = [(source, volumes) for (source, volumes) in options if volumes is not None]
+                if options:
+                    made.add(conc)
+                    plan.append(options[0])
+            if len(plan) < len(dilutions):
+                continue
+            transfers = sum(strokes(vol, max_vol) for (source, volumes) in plan for vol in volumes)
+            intermediate = None
+            if ratio:
+                used = sum(volumes[0] for (source, volumes) in plan if source == "intermediate")
+                if used == 0:
+                    continue
+                # The smallest intermediate stock (up to a 2 mL tube) with enough stock to pipette
+                volumes = None
+                for vol in range(10 * ceil((used + 10) / 10), 2001, 10):
+                    volumes = dilution_volumes(stock_conc / ratio, stock_conc, vol)
+                    if volumes is not None:
+                        break
+                if volumes is None:
+                    continue
+                intermediate = {"ratio": ratio, "vol": vol, "stock_vol": volumes[0], "mq_vol": volumes[1]}
+                transfers += strokes(volumes[0], max_vol) + strokes(volumes[1], max_vol)
+            if best is None or (transfers, dil_vol) < best[0]:
+                levels = plan[:len(counts)]
+                best = ((transfers, dil_vol), {
+                    "dil_vol": dil_vol,
+                    "level_vols": level_vols,
+                    "shares": [list(share) for share in shares],
+                    "stock_vols": [volumes[0] if source == "stock" else 0 for (source, volumes) in levels],
+                    "intermediate_vols": [volumes[0] if source == "intermediate" else 0 for (source, volumes) in levels],
+                    "mq_vols": [volumes[1] for (source, volumes) in levels],
+                    "control": (plan[-1][0], plan[-1][1][0]) if len(plan) > len(counts) else None,
+                    "control_vol": control_vol,
+                    "intermediate": intermediate,
+                })
+    if best is None:
+        failing = [conc for (conc, vol) in dilutions if conc not in made] or [conc for (conc, vol) in dilutions]
+        failing = ["{:g}{}".format(conc, " (control)" if conc not in counts else "") for conc in failing]
+        raise ValueError("Error: No dilutions of at most {} muL make the {} concentrations {} from the {} stock with volumes of at least {} muL. Change {} stock concentration.".format(
+            max_dil_vol, name, ", ".join(failing), stock_conc, min_pipette_vol, name))
+    return best[1]
+
+def stock_needed(plan):
+    """Volume of stock (muL) taken by the dilutions of a plan of plan_dilution()."""
+    needed = sum(plan["stock_vols"]) + (plan["intermediate"]["stock_vol"] if plan["intermediate"] else 0)
+    if plan["control"] is not None and plan["control"][0] == "stock":
+        needed += plan["control"][1]
+    return needed
+
+################################################################################
+#                               Instrumentation                                #
 ################################################################################
 
-# Total number of samples (max. 343 combinations)
-nsamples = len(Mg_final_conc)**3 + 1
+# Calls of the liquid-handling helpers of run(), recorded by traced(). Each call has the
+# name of the helper, its wall time (s) and the range of the protocol commands it issued.
+trace_calls = []
+
+def traced(protocol, function):
+    """Wrap a helper of run() so that its calls are recorded in trace_calls."""
+    def wrapper(*args, **kwargs):
+        call = {"name": function.__name__, "start": time.monotonic(), "first_command": len(protocol.commands())}
+        trace_calls.append(call)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            call.update(end=time.monotonic(), last_command=len(protocol.commands()))
+    return wrapper
+
+def write_trace(path):
+    """Write the traced calls as a Chrome trace (chrome://tracing, Perfetto or speedscope)
+    with their wall time and number of protocol commands."""
+    start = min([call["start"] for call in trace_calls], default=0)
+    events = [{"name": call["name"], "ph": "X", "pid": 1, "tid": 1, "ts": (call["start"] - start) * 1e6,
+               "dur": (call["end"] - call["start"]) * 1e6, "args": {"commands": call["last_command"] - call["first_command"]}}
+              for call in trace_calls if "end" in call]
+    with open(path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+################################################################################
+#                                 Plate layout                                 #
+################################################################################
+
+def plate_positions(nwells):
+    """Well numbers of the first nwells wells that are loaded, counted across all plates.
+    With empty_edges the outer rows and columns of every plate are skipped."""
+    positions = []
+    well_no = 0
+    while len(positions) < nwells:
+        (row, column) = (well_no % 384 % 16, well_no % 384 // 16)
+        if not empty_edges or (0 < row < 15 and 0 < column < 23):
+            positions.append(well_no)
+        well_no += 1
+    return positions
+
+def plate_layout():
+    """Content of every loaded well as (well number, block, sample) in the order of the well
+    numbers. Samples below nsamples - 1 are the conditions in the order of the design,
+    nsamples - 1 is the well with only mastermix and DNA, and nsamples the internal control
+    without DNA. Every block holds one replicate of all samples, see replicates."""
+    if replicates < 1:
+        raise ValueError("Error: The design needs at least 1 replicate, not {}.".format(replicates))
+    rng = random.Random(layout_seed)
+    samples = []
+    for block in range(replicates):
+        order = list(range(nsamples + 1))
+        if block > 0:
+            rng.shuffle(order)
+        samples += [(block, sample) for sample in order]
+    return [(well_no, block, sample) for well_no, (block, sample) in zip(plate_positions(len(samples)), samples)]
+
+################################################################################
+#                                   Plate map                                  #
+################################################################################
+
+def plate_map():
+    """Content of every loaded well in the order of the well numbers: deck slot and name
+    of the well, replicate block, condition (key in the design), concentration of each factor,
+    and whether it is the internal control and gets DNA. Every block has the combinations,
+    a well with only mastermix and DNA, and the internal control without DNA."""
+    (conditions, columns) = read_design(design)
+    wells = []
+    for (well_no, block, sample) in plate_layout():
+        (plate_no, i) = divmod(well_no, 384)
+        well = {"slot": plate_slots[plate_no], "well": "{}{}".format("ABCDEFGHIJKLMNOP"[i % 16], i // 16 + 1), "well_no": well_no, "block": block}
+        if sample < len(conditions):
+            well["condition"] = conditions[sample]
+            well.update({factor["name"]: columns[factor["name"]][sample] for factor in factors})
+        else:
+            well["condition"] = None
+            well.update({factor["name"]: factor["control_conc"] if sample == nsamples else 0 for factor in factors})
+        well["control"] = sample == nsamples
+        well["DNA"] = sample < nsamples
+        wells.append(well)
+    return wells
+
+################################################################################
 
 def run(protocol):
+    trace_calls.clear()
     
     ## Load instrument, modules and labware ##
 
@@ -49,7 +928,8 @@ def run(protocol):
     #              #              #              #
     #------------- #------------- #------------- #
     # PCR strips,  # 15mL falcon  #              #
-    # 4C           # rack         #              #
+    # 4C           # rack (multi: #              #
+    #              # reservoir)   #              #
     #------------- #------------- #------------- #
     #              #              #              #
     #              #              #              #
@@ -57,52 +937,119 @@ def run(protocol):
 
 
     # Pipettes and tips
-    tips20 = protocol.load_labware('opentrons_96_tiprack_20ul', 8)
-    tips300 = protocol.load_labware('opentrons_96_tiprack_300ul', 9)
-    p20 = protocol.load_instrument('p20_single_gen2', mount='left', tip_racks=[tips20])
-    p300 = protocol.load_instrument('p300_single', mount='right', tip_racks=[tips300])
+    tips20 = [protocol.load_labware('opentrons_96_tiprack_20ul', slot) for slot in p20_tip_slots]
+    p20 = protocol.load_instrument('p20_single_gen2', mount='left', tip_racks=tips20)
+    p20_tips = TipTracker(protocol, p20, tips20)
+    if pipette_mode == "single":
+        tips300 = [protocol.load_labware('opentrons_96_tiprack_300ul', slot) for slot in p300_tip_slots]
+        p300 = protocol.load_instrument('p300_single', mount='right', tip_racks=tips300)
+        p300m = None
+        (right_tips, right_racks) = (TipTracker(protocol, p300, tips300), tips300)
+    elif pipette_mode == "multi":
+        tips300m = [protocol.load_labware('opentrons_96_tiprack_300ul', slot) for slot in multi_tip_slots]
+        p300m = protocol.load_instrument('p300_multi_gen2', mount='right', tip_racks=tips300m)
+        p300 = None
+        (right_tips, right_racks) = (TipTracker(protocol, p300m, tips300m), tips300m)
+    else:
+        raise ValueError("Error: Unknown pipette mode {}. Use single or multi.".format(pipette_mode))
 
-    # 384-well plate
-    plate = protocol.load_labware('corning_384_wellplate_112ul_flat', 11)
+    # 384-well plates, loaded as laid out by plate_layout()
+    layout = plate_layout()
+    loaded_wells = [well_no for (well_no, block, sample) in layout]
+    dna_wells = {well_no for (well_no, block, sample) in layout if sample < nsamples}
+    control_wells = [well_no for (well_no, block, sample) in layout if sample == nsamples]
+    nplates = loaded_wells[-1] // 384 + 1
+    if nplates > len(plate_slots):
+        raise ValueError("Error: Design needs {} plates but only {} plate slots are given.".format(nplates, len(plate_slots)))
+    plates = [protocol.load_labware('corning_384_wellplate_112ul_flat', slot) for slot in plate_slots[:nplates]]
+    if len(factors) > 8 or any(len(factor["final_conc"]) > 11 for factor in factors):
+        raise ValueError("Error: Dilutions of max. 8 factors with 11 concentrations each fit in the PCR strips.")
     
-    # Tube rack
-    rack = protocol.load_labware ('opentrons_15_tuberack_falcon_15ml_conical', 5)
+    # Tube rack, or reservoir for the 8-channel pipette
+    if pipette_mode == "single":
+        rack = protocol.load_labware ('opentrons_15_tuberack_falcon_15ml_conical', 5)
+    else:
+        reservoir = protocol.load_labware('nest_12_reservoir_15ml', 5)
 
     # Temperature modules
     temp_module_pcrtubes = protocol.load_module('temperature module gen2', 10)
     pcrtubes_cool = temp_module_pcrtubes.load_labware('opentrons_96_aluminumblock_generic_pcr_strip_200ul')
-    #temp_module_pcrtubes.set_temperature(4)
+    temp_module_pcrtubes.start_set_temperature(4)
+
+    # PCR strips for the aliquots of the dilutions for other robots
+    aliquots = [protocol.load_labware('opentrons_96_aluminumblock_generic_pcr_strip_200ul', slot) for slot in aliquot_slots]
 
     temp_module_eppendorftubes = protocol.load_module('temperature module gen2', 4)
     eppendorftubes_cool = temp_module_eppendorftubes.load_labware('opentrons_24_aluminumblock_nest_2ml_snapcap')
-    #temp_module_eppendorftubes.set_temperature(4)  
+    temp_module_eppendorftubes.start_set_temperature(4)
+
+    # The modules ramp while the dilutions are made, and cool_down() waits for them
+    # before the lysate and DNA are handled.
     
     ## Define start reagents
 
-    # In Eppendorf module
+    # In Eppendorf module (starting volumes in start_volumes and stock_vol)
     # A1. DNA: 200 muL
-    # A2. Buffer: 1.5 mL
-    # A3. Lysate: 2 mL
+    # A2. Buffer: 1.5 mL, continued in free tubes of rows C-D when it does not fit
+    # A3. Lysate: 2 mL, continued in free tubes of rows C-D when it does not fit
     # A4. MilliQ: 2 mL
     # B1. Mg-glutamate: 100 muL 1M
     # B2. K-glutamate: 300 muL 2M
     # B3. PEG-8000: 350 muL 40%
+    # Stock solutions of any further factors at their stock_well
+    # Intermediate stocks planned by plan_dilution() in the free tubes of rows C-D
     DNA = eppendorftubes_cool.wells_by_name()["A1"]
-    BufferW = eppendorftubes_cool.wells_by_name()["A2"]
-    Lysate = eppendorftubes_cool.wells_by_name()["A3"]
+    BufferW = [eppendorftubes_cool.wells_by_name()["A2"]]
+    Lysate = [eppendorftubes_cool.wells_by_name()["A3"]]
     MQ = eppendorftubes_cool.wells_by_name()["A4"]
-    Mg_glut = eppendorftubes_cool.wells_by_name()["B1"]
-    K_glut = eppendorftubes_cool.wells_by_name()["B2"]
-    PEG8000 = eppendorftubes_cool.wells_by_name()["B3"]
+    stocks = {factor["name"]: eppendorftubes_cool.wells_by_name()[factor["stock_well"]] for factor in factors}
+    free_tubes = [well for well in eppendorftubes_cool.rows()[2] + eppendorftubes_cool.rows()[3] if well not in stocks.values()]
+    intermediates = {factor["name"]: well for factor, well in zip(factors, free_tubes)}
+
+    if pipette_mode == "single":
+        # In rack
+        MM = rack.wells_by_name()["A1"]
+        spare_tubes = free_tubes[len(factors):]
+        for (tubes, name) in ((BufferW, "Buffer"), (Lysate, "Lysate")):
+            extra = ceil(start_volumes[name] / tubes[0].max_volume - 1e-9) - 1
+            if extra > len(spare_tubes):
+                raise ValueError("Error: {} muL {} needs {} tubes, but only {} are free. Use a smaller design or fewer replicates.".format(
+                    start_volumes[name], name, extra + 1, len(spare_tubes) + 1))
+            tubes += spare_tubes[:extra]
+            spare_tubes = spare_tubes[extra:]
+    else:
+        # In reservoir (multi mode)
+        # A1. Lysate: 2 mL
+        # A2. Buffer: 1.5 mL
+        # A3. Empty for the mastermix
+        Lysate = [reservoir.wells_by_name()["A1"]]
+        BufferW = [reservoir.wells_by_name()["A2"]]
+        MM = reservoir.wells_by_name()["A3"]
 
-    # In rack
-    MM = rack.wells_by_name()["A1"]
+    # Volumes of the reagents, checked against the design by liquid.check()
+    liquid = LiquidTracker()
+    for (well, name) in ((DNA, "DNA"), (MQ, "MilliQ")):
+        liquid.load(well, start_volumes[name], name)
+    for (tubes, name) in ((BufferW, "Buffer"), (Lysate, "Lysate")):
+        for tube in tubes:
+            liquid.load(tube, start_volumes[name] / len(tubes), name)
+        if len(tubes) > 1:
+            protocol.comment("{}: {:g} muL in each of {}".format(name, start_volumes[name] / len(tubes), ", ".join(tube.well_name for tube in tubes)))
+    for factor in factors:
+        liquid.load(stocks[factor["name"]], factor["stock_vol"], factor["name"])
+    for factor in factors:
+        liquid.load(intermediates[factor["name"]], 0, "{} intermediate".format(factor["name"]))
+    liquid.load(MM, 0, "mastermix")
+    for i, factor in enumerate(factors):
+        for well in pcrtubes_cool.rows()[i]:
+            liquid.load(well, 0, "{} dilution".format(factor["name"]))
+        for aliquot in aliquots:
+            for well in aliquot.rows()[i]:
+                liquid.load(well, 0, "{} aliquot".format(factor["name"]))
     
-    # Tip tracker
-    p20_st = 1
-    p300_st = 1
-    p20.starting_tip = tips20.wells()[p20_st]
-    p300.starting_tip = tips300.wells()[p300_st]
+    def plate_well(well_no):
+        """Return the well for a well number counted across all plates."""
+        return plates[well_no // 384].wells()[well_no % 384]
 
     def find_index(lst,item):
         if item in lst:
@@ -110,329 +1057,461 @@ def run(protocol):
         else:
             return None   
 
-    def sorted_factors_to_lst(factors,reagent):
-        """Extract factor values from pandas dataframe.
-        Input is a string with name of reagent and outputs a sorted list"""
-        lst = factors[reagent].tolist()
-        lst.sort()
-        return lst
-
-    def pipette_viscious(mode):
-        """Decrease flow rate for pipettes suitable for vicous liquids."""
-        if mode == 0:     # OFF
-                p20.flow_rate.aspirate = 7.56
-                p20.flow_rate.dispense = 7.56
-                p300.flow_rate.aspirate = 92.86
-                p300.flow_rate.dispense = 92.86
-        if mode == 1:     # ON
-                p20.flow_rate.aspirate = 2
-                p20.flow_rate.dispense = 2
-                p300.flow_rate.aspirate = 10
-                p300.flow_rate.dispense = 10
-
-    def transfer_small_vol_to_well(well_start, well_stop, reagent,p20_st):
-        """Transfer 0.5 uL of reagent to a range of destination wells in the well plate."""
-        p20.pick_up_tip(tips20.wells()[p20_st])
-        total_vol = ((well_stop - well_start) * 0.5) + 1
-        if total_vol >= 38:
-            i = 0
-            while i < well_stop:
-                if i+38 < well_stop:
-                    p20.aspirate(location=reagent.bottom(1))
-                    for well_no in range(i, i+38):
-                        p20.dispense(0.5, plate.wells()[well_no].bottom(0.1))
-                else:
-                    p20.blow_out(reagent)
-                    p20.aspirate((well_stop-i) * 0.5, reagent.bottom(1))
-                    for well_no in range(i, well_stop):
-                        p20.dispense(0.5, plate.wells()[well_no].bottom(0.1))
-                i+=38
-        else:
-            p20.aspirate(total_vol, reagent.bottom(1))
-            for well_no in range(well_start, well_stop):
-                p20.dispense(0.5, plate.wells()[well_no].bottom(0.1))
-        p20.drop_tip()
+    def index_level_wells(columns, factor_dict):
+        """Build the lookup from each factor level to the wells holding it, once per run.
+        Levels are sorted and the wells of every replicate of a condition are taken from the layout."""
+        level_wells = {}
+        for reagent, levels in factor_dict.items():
+            unknown = sorted(set(columns[reagent]) - set(levels))
+            if unknown:
+                raise ValueError("Error: The design has {} concentrations {} that are not in its final_conc.".format(reagent, unknown))
+            level_wells[reagent] = {level: [] for level in sorted(levels)}
+            for (well_no, block, sample) in layout:
+                if sample < len(columns[reagent]):
+                    level_wells[reagent][columns[reagent][sample]].append(well_no)
+        return level_wells
+
+    def loading_blocks():
+        """Blocks of block_columns plate columns that get mastermix and DNA together."""
+        blocks = {}
+        for well_no in loaded_wells:
+            blocks.setdefault(well_no // (16 * block_columns), []).append(well_no)
+        return list(blocks.values())
+
+    def workflow(protocol, temp_module_pcrtubes, temp_module_eppendorftubes, p20, p300, p300m, p20_tips, right_tips):
+        """Make the dilutions, load the control and the combinations, and load the
+        mastermix and DNA as set by the scheduler. The protocol, modules, pipettes and tip
+        trackers are passed in, so the dry run that counts the tips can pass stand-ins.
+        p300m and p300 are None when not mounted, and right_tips serves either of them."""
+        p300_tips = p300m_tips = right_tips
+
+        def pipette_viscious(mode):
+            """Decrease flow rate for pipettes suitable for vicous liquids."""
+            if mode == 0:     # OFF
+                    p20.flow_rate.aspirate = 7.56
+                    p20.flow_rate.dispense = 7.56
+                    if p300 is not None:
+                        p300.flow_rate.aspirate = 92.86
+                        p300.flow_rate.dispense = 92.86
+                    if p300m is not None:
+                        p300m.flow_rate.aspirate = 94
+                        p300m.flow_rate.dispense = 94
+            if mode == 1:     # ON
+                    p20.flow_rate.aspirate = 2
+                    p20.flow_rate.dispense = 2
+                    if p300 is not None:
+                        p300.flow_rate.aspirate = 10
+                        p300.flow_rate.dispense = 10
+                    if p300m is not None:
+                        p300m.flow_rate.aspirate = 10
+                        p300m.flow_rate.dispense = 10
+
+        def multi_dispense(pipette, vol, reagent, wells, disposal_vol=1):
+            """Dispense the same volume of reagent to a list of wells with as few fills of
+            the pipette as possible. The disposal volume is blown out back into the reagent
+            before the pipette is filled again."""
+            channels = 8 if "multi" in pipette.name else 1
+            fills = plan_fills(len(wells), vol, pipette.max_volume, disposal_vol)
+            for i, nwells in enumerate(fills):
+                if i > 0 or pipette.current_volume > 0:
+                    liquid.add(reagent, pipette.current_volume, channels)
+                    pipette.blow_out(reagent)
+                pipette.aspirate(nwells * vol + disposal_vol, liquid.take(reagent, nwells * vol + disposal_vol, channels))
+                for well in wells[:nwells]:
+                    pipette.dispense(vol, well.bottom(0.1))
+                wells = wells[nwells:]
+
+        def transfer_small_vol_to_well(well_no_lst, reagent):
+            """Transfer 0.5 uL of reagent to a list of destination wells in the well plate."""
+            p20_tips.pick_up(reagent)
+            multi_dispense(p20, 0.5, reagent, [plate_well(well_no) for well_no in well_no_lst])
+            p20_tips.drop()
     
-    def transfer_combinations_of_small_vol_to_well(well_no_lst, reagent, vol, p20_st):
-        """Transfer a small volume down to 0.5 uL of reagent to a list of destination 
-        wells in the well plate."""
-        p20.pick_up_tip(tips20.wells()[p20_st])
-        i = 0
-        if vol == 0.5:
-            dispenses_pr_fill = 38
-        elif vol == 0.75:
-            dispenses_pr_fill = 24
-        elif vol == 1.5:
-            dispenses_pr_fill = 12
-        while i < len(well_no_lst):
-            if i+dispenses_pr_fill < len(well_no_lst):
-                p20.aspirate(location=reagent.bottom(1))
-                for well_no in well_no_lst[i:i+dispenses_pr_fill]:
-                    p20.dispense(vol, plate.wells()[well_no].bottom(0.1))
-                p20.blow_out(reagent)
+        def transfer_combinations_of_small_vol_to_well(well_no_lst, reagent, vol):
+            """Transfer a small volume down to 0.5 uL of reagent to a list of destination 
+            wells in the well plate."""
+            p20_tips.pick_up(reagent)
+            multi_dispense(p20, vol, reagent, [plate_well(well_no) for well_no in well_no_lst])
+            release_tip(p20, p20_tips, reagent)
+
+        def release_tip(pipette, tips, reagent):
+            """Drop the tip, or with the blocks scheduler blow out the disposal volume back into
+            the reagent and return the tip to its rack for the next block."""
+            if scheduler == "blocks":
+                if pipette.current_volume > 0:
+                    liquid.add(reagent, pipette.current_volume)
+                    pipette.blow_out(reagent)
+                tips.keep()
             else:
-                p20.aspirate((len(well_no_lst)-i) * vol, reagent.bottom(1))
-                for well_no in well_no_lst[i:len(well_no_lst)]:
-                    p20.dispense(vol, plate.wells()[well_no].bottom(0.1))
-            i+=dispenses_pr_fill
-        p20.drop_tip()
+                tips.drop()
     
-    def make_single_dilution(vol,reagent_stock,row,p20_st):
-        """Dilute the stock concentration to the reference concentration if not part of the serial dilutions."""
-        p20.pick_up_tip(tips20.wells()[p20_st])
-        p20.transfer(vol, reagent_stock, pcrtubes_cool.wells()[row], touch_tip=True, new_tip="never")
-        p20.drop_tip()
-        p20.pick_up_tip(tips20.wells()[p20_st+1])
-        p20.transfer(10-vol, MQ, pcrtubes_cool.wells()[row], touch_tip=True, mix_after=(5,5), new_tip="never")
-        p20.drop_tip()
-
-    def load_control(factors,p20_st):
-        """Load the internal control (without DNA) to the well plate with 3 mM Mg-glutamate, 
-        60 mM K-glutamate, and 2% PEG-8000."""
-
-        # No DNA
-        p20.pick_up_tip(tips20.wells()[0])
-        p20.aspirate(1,MQ)
-        p20.dispense(0.5, plate.wells()[nsamples])
-        p20.drop_tip()
-
-        # Add reference factors
-        Mg_final_conc = sorted_factors_to_lst(factors,'Mg-glutamate')
-        K_final_conc = sorted_factors_to_lst(factors,'K-glutamate')
-        P_final_conc = sorted_factors_to_lst(factors,'PEG-8000')
-        if find_index(Mg_final_conc,3) is not None:
-            dil_well = "A{}".format(find_index(Mg_final_conc,3)+2)
-        else:
-            # Make dilution and add to well
-            dil_well = "A1"
-            make_single_dilution(0.6,Mg_glut,0,p20_st)
-            p20_st += 2
-        p20.pick_up_tip(tips20.wells()[p20_st])
-        p20.transfer(0.5, pcrtubes_cool.wells_by_name()[dil_well], plate.wells()[nsamples], touch_tip=True, new_tip="never")
-        p20.drop_tip()
-        p20_st += 1
-        if find_index(K_final_conc,60) is not None:
-            dil_well = "B{}".format(find_index(K_final_conc,60)+2)
-        else:
-            # Make dilution and add to well
-            dil_well = "B1"
-            make_single_dilution(4,K_glut,1,p20_st)
-            p20_st += 2
-        p20.pick_up_tip(tips20.wells()[p20_st])
-        p20.transfer(0.75, pcrtubes_cool.wells_by_name()[dil_well], plate.wells()[nsamples], touch_tip=True, new_tip="never")
-        p20.drop_tip()
-        p20_st += 1
-        if find_index(P_final_conc,2) is not None:
-            dil_well = "C{}".format(find_index(P_final_conc,2)+2)
-        else:
-            # Make dilution and add to well
-            dil_well = "C1"
-            make_single_dilution(3.3,PEG8000,2,p20_st)
-            p20_st += 2
-        p20.pick_up_tip(tips20.wells()[p20_st])
-        p20.transfer(1.5, pcrtubes_cool.wells_by_name()[dil_well], plate.wells()[nsamples], touch_tip=True, new_tip="never")
-        p20.drop_tip()
-        p20_st += 1
-
-        return p20_st
+        def make_single_dilution(vol,reagent_stock,row,total_vol):
+            """Dilute the stock concentration to the reference concentration if not part of the serial dilutions."""
+            p20_tips.pick_up(reagent_stock)
+            p20.transfer(vol, liquid.take(reagent_stock, vol), pcrtubes_cool.wells()[row], touch_tip=True, new_tip="never")
+            p20_tips.drop()
+            p20_tips.pick_up(MQ)
+            p20.transfer(total_vol-vol, liquid.take(MQ, total_vol-vol), pcrtubes_cool.wells()[row], touch_tip=True, mix_after=(5,5), new_tip="never")
+            p20_tips.drop()
+            liquid.add(pcrtubes_cool.wells()[row], total_vol)
+
+        def control_well(level_wells, i, factor):
+            """Name of the PCR strip well with the control concentration of a factor,
+            and whether it has to be diluted from the stock."""
+            final_conc = list(level_wells[factor["name"]])
+            row_name = "ABCDEFGH"[i]
+            if find_index(final_conc,factor["control_conc"]) is not None:
+                return "{}{}".format(row_name, find_index(final_conc,factor["control_conc"])+2), False
+            return "{}1".format(row_name), True
+
+        def make_control_dilutions(level_wells, plans):
+            """Make the dilutions of the control concentrations that are not in the design."""
+            for i, factor in enumerate(factors):
+                if control_well(level_wells, i, factor)[1]:
+                    (source, vol) = plans[factor["name"]]["control"]
+                    make_single_dilution(round(vol, 1), stocks[factor["name"]] if source == "stock" else intermediates[factor["name"]], i, plans[factor["name"]]["control_vol"])
+
+        def load_control(level_wells, well_nos):
+            """Load the internal controls (without DNA) to the well plate with the control
+            concentration of every factor, e.g. 3 mM Mg-glutamate, 60 mM K-glutamate, and 2% PEG-8000."""
+            if not well_nos:
+                return
+
+            # No DNA
+            p20_tips.pick_up(MQ)
+            p20.aspirate(0.5 * len(well_nos) + 0.5, liquid.take(MQ, 0.5 * len(well_nos) + 0.5))
+            for well_no in well_nos:
+                p20.dispense(0.5, plate_well(well_no))
+            release_tip(p20, p20_tips, MQ)
+
+            # Add reference factors. The tip is kept for loading the same dilution to the combinations.
+            for i, factor in enumerate(factors):
+                dil_well = pcrtubes_cool.wells_by_name()[control_well(level_wells, i, factor)[0]]
+                p20_tips.pick_up(dil_well)
+                p20.transfer(factor["well_vol"], liquid.take(dil_well, factor["well_vol"] * len(well_nos)),
+                             [plate_well(well_no) for well_no in well_nos], touch_tip=True, new_tip="never")
+                p20_tips.keep()
         
-    def calc_volume(reagent, final_conc_lst, stock_conc, final_vol, dil_factor):
-        """
-        Calculate volumes of reagent stock/dilution to get final concentration.
-        Takes in a list of final concentrations, final volume, name of reagent and dilution factor
-        and outputs two lists with volumes of stock/dilution and MilliQ.
-        """
-        reagent_vol_lst = []
-        mq_vol_lst = []
-        for i in range(len(final_conc_lst)):
-            vol = ((final_conc_lst[i]*dil_factor)*final_vol)/stock_conc
-            if vol > final_vol:
-                raise ValueError("Error: Stock volume exceeds 30 muL. Change {} stock concentration.".format(reagent))
-            elif vol < 0.5 and vol != 0:
-                raise ValueError("Error: Stock volume lower than minimum required volume 0.5 muL. Change {} stock concentration.".format(reagent))
-            else:
-                if final_vol == ceil(vol):
-                    reagent_vol_lst.append(ceil(vol))
-                    mq_vol_lst.append(0)
-                else:
-                    if final_vol-vol < 0.5:
-                        raise ValueError("Error: MilliQ volume lower than minimum required volume 0.5 muL. Change {} stock concentration.".format(reagent))
-                    else:
-                        reagent_vol_lst.append(vol)
-                        mq_vol_lst.append(final_vol-vol)
-        return reagent_vol_lst, mq_vol_lst
-    
-    def add_MQ(MQ_vol_lst,row):
-        """Adds MilliQ to serial dilution, designed to reuse tips to save plastic."""
-        if any(vol > 20 for vol in MQ_vol_lst):
-            for i in range(len(MQ_vol_lst)):
-                if MQ_vol_lst[i] == 0:
-                    pass
-                elif MQ_vol_lst[i] <= 20:
-                    p20.pick_up_tip(tips20.wells()[0])
-                    p20.transfer(MQ_vol_lst[i], MQ, row[i+1], new_tip="never")
-                    p20.return_tip()
-                else:
-                    p300.pick_up_tip(tips300.wells()[0])
-                    p300.transfer(MQ_vol_lst[i], MQ, row[i+1], new_tip="never")
-                    p300.return_tip()
-        else:
-            p20.pick_up_tip(tips20.wells()[0])
-            p20.transfer(MQ_vol_lst, MQ, row[1:len(Mg_final_conc)+1], new_tip="never")
-            p20.return_tip()
-    
-    def add_reagent(reagent_vol_lst,reagent_stock,row,p20_st,p300_st):
-        """Adds and mixes reagent to serial dilution, designed to reuse tips to save plastic."""
-        if any(vol > 20 for vol in reagent_vol_lst):
-            for i in range(len(reagent_vol_lst)):
-                if reagent_vol_lst[i] == 0:
-                    pass
-                elif reagent_vol_lst[i] <= 20:
-                    p20.pick_up_tip(tips20.wells()[p20_st])
-                    p20.transfer(reagent_vol_lst[i], reagent_stock, row[i+1], mix_after=(5,15), new_tip="never")
-                    if i != len(reagent_vol_lst)-1:
-                        if reagent_vol_lst[i+1] <= 20:
-                            p20.return_tip()
-                        else:
-                            p20.drop_tip()
-                    else:
-                        p20.drop_tip()
+        def dispense_volumes(pipette, vol_lst, reagent, wells, disposal_vol=1):
+            """Dispense different volumes of reagent to a list of wells with as few fills of
+            the pipette as possible, and blow out the disposal volume back into the reagent.
+            A fill for a single dispense is transferred without disposal volume."""
+            for fill in plan_volume_fills(vol_lst, pipette.max_volume, disposal_vol):
+                vol = sum(part for (i, part) in fill) + (disposal_vol if len(fill) > 1 else 0)
+                pipette.aspirate(vol, liquid.take(reagent, vol))
+                for (i, part) in fill:
+                    pipette.dispense(part, wells[i])
+                if len(fill) > 1:
+                    liquid.add(reagent, pipette.current_volume)
+                    pipette.blow_out(reagent)
+            for (vol, well) in zip(vol_lst, wells):
+                liquid.add(well, vol)
+
+        def add_MQ(plans):
+            """Adds the MilliQ of all dilutions and intermediate stocks before any reagent, in one
+            multi-dispense pass per pipette. The tubes are still empty, so one tip per pipette
+            serves all rows and is kept for later MilliQ. Without the P300 the P20 dispenses
+            the volumes above 20 uL in several parts."""
+            additions = []
+            for i, factor in enumerate(factors):
+                plan = plans[factor["name"]]
+                if plan["intermediate"]:
+                    additions.append((plan["intermediate"]["mq_vol"], intermediates[factor["name"]]))
+                additions += list(zip(plan["mq_vols"], pcrtubes_cool.rows()[i][1:]))
+            additions = [(vol, well) for (vol, well) in additions if vol > 0]
+            for (pipette, tips, large) in ((p20, p20_tips, False), (p300, right_tips, True)):
+                batch = [(vol, well) for (vol, well) in additions if (vol > 20 and p300 is not None) == large]
+                if batch:
+                    tips.pick_up(MQ)
+                    dispense_volumes(pipette, [vol for (vol, well) in batch], MQ, [well for (vol, well) in batch])
+                    tips.keep()
+
+        def add_reagent(reagent_vol_lst,reagent_stock,row):
+            """Adds and mixes reagent to serial dilution, designed to reuse tips to save plastic.
+            The volumes up to 20 uL are added with the P20 and the larger ones with the P300, so
+            the pipettes are switched at most once per reagent. The tips are kept for a dilution
+            of the same stock for the internal control."""
+            wells = [(vol, well) for (vol, well) in zip(reagent_vol_lst, row[1:len(reagent_vol_lst)+1]) if vol > 0]
+            for (vol, well) in wells:
+                liquid.add(well, vol)
+            small = [(vol, well) for (vol, well) in wells if vol <= 20 or p300 is None]
+            large = [(vol, well) for (vol, well) in wells if vol > 20 and p300 is not None]
+            if small:
+                p20_tips.pick_up(reagent_stock)
+                if all(vol <= 20 for (vol, well) in small):
+                    p20.transfer([vol for (vol, well) in small], liquid.take(reagent_stock, sum(vol for (vol, well) in small)), [well for (vol, well) in small], mix_after=(5,15), new_tip="never")
                 else:
-                    p300.pick_up_tip(tips300.wells()[p300_st])
-                    p300.transfer(reagent_vol_lst[i], reagent_stock, row[i+1], mix_after=(5,15), new_tip="never")
-                    if i != len(reagent_vol_lst)-1:
-                        if reagent_vol_lst[i+1] > 20:
-                            p300.return_tip()
-                        else:
-                            p300.drop_tip()
-                    else:
-                        p300.drop_tip()
-            p20_st += 1
-            p300_st += 1
-        else:
-            p20.pick_up_tip(tips20.wells()[p20_st])
-            p20.transfer(reagent_vol_lst, reagent_stock, row[1:len(Mg_final_conc)+1], mix_after=(5,15), new_tip="never")
-            p20.drop_tip()
-            p20_st += 1
-        return p20_st, p300_st    
-
-    def factors_dilution(factors,Mg_stock_conc,K_stock_conc,P_stock_conc,p20_st,p300_st):
-        """Make dilutions of Mg-glut, Mg-glut and PEG-8000
-        based on csv file input."""
+                    # Volumes above 20 uL are transferred in several steps and mixed once at the end
+                    for (vol, well) in small:
+                        p20.transfer(vol, liquid.take(reagent_stock, vol), well, new_tip="never")
+                        p20.mix(5, 15, well)
+                p20_tips.keep()
+            if large:
+                p300_tips.pick_up(reagent_stock)
+                p300.transfer([vol for (vol, well) in large], liquid.take(reagent_stock, sum(vol for (vol, well) in large)), [well for (vol, well) in large], mix_after=(5,15), new_tip="never")
+                p300_tips.keep()
+
+        def make_intermediate(factor, intermediate):
+            """Add the stock of a factor to the MilliQ of its intermediate stock and mix.
+            The tip is kept for the dilutions."""
+            (well, vol, stock) = (intermediates[factor["name"]], intermediate["stock_vol"], stocks[factor["name"]])
+            (pipette, tips) = (p300, p300_tips) if vol > 20 and p300 is not None else (p20, p20_tips)
+            tips.pick_up(stock)
+            pipette.transfer(vol, liquid.take(stock, vol), well, new_tip="never")
+            liquid.add(well, vol)
+            pipette.mix(5, min(pipette.max_volume, intermediate["vol"] / 2), liquid.take(well, 0))
+            tips.keep()
+
+        def factors_dilution(plans):
+            """Make dilutions of every factor, e.g. Mg-glut, K-glut and PEG-8000,
+            with one row of PCR strips per factor, as planned by plan_dilution()."""
         
-        # Load reagent's final concentration
-        Mg_final_conc = sorted_factors_to_lst(factors,'Mg-glutamate')
-        K_final_conc = sorted_factors_to_lst(factors,'K-glutamate')
-        P_final_conc = sorted_factors_to_lst(factors,'PEG-8000')
-
-        # Prepare dilutions
-        for i in range(3):
-            row = pcrtubes_cool.rows()[i]
-            if i == 0:    # Mg-glutamate
-                (Mg_glut_vol_lst, MQ_vol_lst) = calc_volume("Mg-glutamate",Mg_final_conc,Mg_stock_conc,30,20) # final volume is 30 muL
-                add_MQ(MQ_vol_lst,row)
-                (p20_st,p300_st) = add_reagent(Mg_glut_vol_lst,Mg_glut,row,p20_st,p300_st)
-            elif i == 1:  # K-glutamate
-                (K_glut_vol_lst, MQ_vol_lst) = calc_volume("K-glutamate",K_final_conc,K_stock_conc,50,13) # final volume is 50 muL
-                add_MQ(MQ_vol_lst,row)
-                (p20_st,p300_st) = add_reagent(K_glut_vol_lst,K_glut,row,p20_st,p300_st)
-            elif i == 2:  # PEG-8000
-                (PEG8000_vol_lst, MQ_vol_lst) = calc_volume("PEG-8000",P_final_conc,P_stock_conc,80,6.66) # final volume is 80 muL
-                add_MQ(MQ_vol_lst,row)
+            # Prepare dilutions: MilliQ of all rows first, then the reagents row by row
+            add_MQ(plans)
+            for i, factor in enumerate(factors):
+                row = pcrtubes_cool.rows()[i]
+                plan = plans[factor["name"]]
+                if factor["viscous"]:
+                    pipette_viscious(1)  # ON
+                if plan["intermediate"]:
+                    make_intermediate(factor, plan["intermediate"])
+                if any(plan["stock_vols"]):
+                    add_reagent(plan["stock_vols"],stocks[factor["name"]],row)
+                if any(plan["intermediate_vols"]):
+                    add_reagent(plan["intermediate_vols"],intermediates[factor["name"]],row)
+                if factor["viscous"]:
+                    pipette_viscious(0)  # OFF
+
+        def share_dilutions(plans):
+            """Dispense an aliquot of every dilution to the PCR strips of the aliquot blocks
+            for the other robots, with one tip per dilution."""
+            for i, factor in enumerate(factors):
+                shares = plans[factor["name"]]["shares"]
+                (pipette, tips) = (p300, p300_tips) if max(max(share) for share in shares) > 20 and p300 is not None else (p20, p20_tips)
+                if factor["viscous"]:
+                    pipette_viscious(1)  # ON
+                for j in range(len(plans[factor["name"]]["mq_vols"])):
+                    source = pcrtubes_cool.rows()[i][j+1]
+                    tips.pick_up(source)
+                    dispense_volumes(pipette, [share[j] for share in shares], source, [aliquot.rows()[i][j+1] for aliquot in aliquots])
+                    tips.drop()
+                if factor["viscous"]:
+                    pipette_viscious(0)  # OFF
+
+        def cool_down():
+            """Wait for both temperature modules to reach 4C."""
+            temp_module_pcrtubes.await_temperature(4)
+            temp_module_eppendorftubes.await_temperature(4)
+
+        def cfe_mastermix():
+            """Prepare mastermix excl. factors to optimize.
+            Mastermix consits of BufferW and lysate. The tip is kept on the pipette for load_mastermix."""
+         
+            lysate_vol = 4 * len(dna_wells) * 1.3 #uL
+            bufferW_vol = 3 * len(dna_wells) * 1.3  #uL
+            if pipette_mode == "single":
+                p300_tips.pick_up(MM)
+                for tube in Lysate:
+                    p300.transfer(lysate_vol / len(Lysate), liquid.take(tube, lysate_vol / len(Lysate)), MM,  touch_tip=True, blow_out=True, blowout_location='source well', new_tip="never")
                 pipette_viscious(1)  # ON
-                (p20_st,p300_st) = add_reagent(PEG8000_vol_lst,PEG8000,row,p20_st,p300_st)
+                for tube in BufferW:
+                    p300.transfer(bufferW_vol / len(BufferW), liquid.take(tube, bufferW_vol / len(BufferW)), MM, blow_out=True, blowout_location='source well', new_tip="never")
                 pipette_viscious(0)  # OFF
-        
-        # Trash MQ 300 uL pipette tip
-        p300.pick_up_tip(tips300.wells()[0])
-        p300.drop_tip()
-        return p20_st,p300_st
-
-    def MM_vol(nsamples):
-        """Adjust z-axis for mixing mastermix dependent on the number of samples"""
-        return 0.1*(nsamples)
-
-    def cfe_mastermix(p300_st):
-        """Prepare mastermix excl. factors to optimize and loads to well plate.
-        Mastermix consits of BufferW and lysate"""
-         
-        lysate_vol = 4 * nsamples * 1.3 #uL
-        bufferW_vol = 3 * nsamples * 1.3  #uL
-        p300.pick_up_tip(tips300.wells()[p300_st])
-        p300.transfer(lysate_vol, Lysate, MM,  touch_tip=True, blow_out=True, blowout_location='source well', new_tip="never")
-        pipette_viscious(1)  # ON
-        p300.transfer(bufferW_vol, BufferW, MM, blow_out=True, blowout_location='source well', new_tip="never")
-        pipette_viscious(0)  # OFF
-        pos = MM_vol(nsamples)
-        for i in range(20):
-            p300.aspirate(300, MM.bottom(1))
-            p300.dispense(300, MM.bottom(pos))
-        p300.distribute(7, MM, plate.wells()[:nsamples+1], blow_out=True, blowout_location='source well', new_tip="never")
-        p300.drop_tip()
-        p300_st += 1 
-        return p300_st 
+                liquid.add(MM, lysate_vol + bufferW_vol)
+                # Mix from below the meniscus to its top, with at most half of the mastermix
+                mix_vol = min(300, (lysate_vol + bufferW_vol) / 2)
+                for i in range(20):
+                    p300.aspirate(mix_vol, liquid.take(MM, mix_vol))
+                    liquid.add(MM, mix_vol)
+                    p300.dispense(mix_vol, MM.bottom(liquid.height(MM)))
+            else:
+                # Each of the 8 channels moves an eighth of the volumes in the reservoir
+                p300m_tips.pick_up(MM)
+                p300m.transfer(lysate_vol / 8, liquid.take(Lysate[0], lysate_vol / 8, 8), MM, blow_out=True, blowout_location='source well', new_tip="never")
+                pipette_viscious(1)  # ON
+                p300m.transfer(bufferW_vol / 8, liquid.take(BufferW[0], bufferW_vol / 8, 8), MM, blow_out=True, blowout_location='source well', new_tip="never")
+                pipette_viscious(0)  # OFF
+                liquid.add(MM, lysate_vol + bufferW_vol)
+                mix_vol = min(300, (lysate_vol + bufferW_vol) / 8 / 2)
+                location = liquid.take(MM, mix_vol, 8)
+                liquid.add(MM, mix_vol, 8)
+                p300m.mix(20, mix_vol, location)
+
+        def load_mastermix(well_nos):
+            """Load 7 uL mastermix to a range of well numbers. In multi mode the 8-channel
+            pipette loads the half columns, and the P20 the remaining wells."""
+            if pipette_mode == "single":
+                p300.distribute(7, liquid.take(MM, 7 * len(well_nos)), [plate_well(well_no) for well_no in well_nos], blow_out=True, blowout_location='source well', new_tip="never")
+            else:
+                (columns, rest) = half_columns(well_nos)
+                multi_dispense(p300m, 7, MM, [plate_well(well_no) for well_no in columns])
+                if rest:
+                    p20_tips.pick_up(MM)
+                    multi_dispense(p20, 7, MM, [plate_well(well_no) for well_no in rest])
+                    p20_tips.drop()
+
+        def load_blocks(blocks, block_paths, level_wells):
+            """Load mastermix, control, combinations and DNA block by block, so the factors are
+            added to the mastermix and the time from mastermix to DNA is about the same in every
+            well. The mastermix pipette keeps its tip between the blocks, and the P20 returns
+            the tip of every dilution and of the DNA to the rack for the next block."""
+            for block, level_paths in zip(blocks, block_paths):
+                in_block = set(block)
+                protocol.comment("Phase: mastermix")
+                load_mastermix(block)
+                protocol.comment("Phase: control")
+                load_control(level_wells, [well_no for well_no in control_wells if well_no in in_block])
+                protocol.comment("Phase: combinations")
+                load_combinations(level_paths)
+                protocol.comment("Phase: DNA")
+                p20_tips.pick_up(DNA)
+                multi_dispense(p20, 0.5, DNA, [plate_well(well_no) for well_no in block if well_no in dna_wells])
+                release_tip(p20, p20_tips, DNA)
+            right_tips.drop()
     
-    def load_combinations(factors, p20_st):
-        """Makes a full factorial experimental design for the 3 factors
-        Mg-glutamate, K-glutamate and PEG-8000. This is used to load
-        all possible combinations. All wells with the same condition 
-        for a factor is loaded simultanously to the 384-well plate. 
-        Input is the csv file with factors."""
-
-        ff = pd.DataFrame.from_dict(ff_dict)
-        Mg_final_conc = sorted_factors_to_lst(factors,'Mg-glutamate')
-        K_final_conc = sorted_factors_to_lst(factors,'K-glutamate')
-        P_final_conc = sorted_factors_to_lst(factors,'PEG-8000')
-
-        # Add Mg-glutamate combinations
-        for i in range(len(Mg_final_conc)):
-            conc_i = ff["Mg-glutamate"]==Mg_final_conc[i]
-            conc_i_wells = []
-            [conc_i_wells.append(j) for j in range(len(conc_i)) if conc_i.tolist()[j] ]
-            dil_well = "A{}".format(i+2)
-            transfer_combinations_of_small_vol_to_well(conc_i_wells, pcrtubes_cool.wells_by_name()[dil_well], 0.5, p20_st)
-            p20_st += 1
-
-        # Add K-glutamate combinations
-        for i in range(len(K_final_conc)):
-            conc_i = ff["K-glutamate"]==K_final_conc[i]
-            conc_i_wells = []
-            [conc_i_wells.append(j) for j in range(len(conc_i)) if conc_i.tolist()[j] ]
-            dil_well = "B{}".format(i+2)
-            transfer_combinations_of_small_vol_to_well(conc_i_wells, pcrtubes_cool.wells_by_name()[dil_well], 0.75, p20_st)
-            p20_st += 1
-
-        # Add PEG-8000 combinations
-        pipette_viscious(1)  # ON
-        for i in range(len(P_final_conc)):
-            conc_i = ff["PEG-8000"]==P_final_conc[i]
-            conc_i_wells = []
-            [conc_i_wells.append(j) for j in range(len(conc_i)) if conc_i.tolist()[j] ]
-            dil_well = "C{}".format(i+2)
-            transfer_combinations_of_small_vol_to_well(conc_i_wells, pcrtubes_cool.wells_by_name()[dil_well], 1.5, p20_st)
-            p20_st += 1
-        pipette_viscious(0)  # OFF
-        return p20_st
+        def load_combinations(level_wells):
+            """Makes a full factorial experimental design for the factors,
+            e.g. Mg-glutamate, K-glutamate and PEG-8000. This is used to load
+            all combinations in the design. All wells with the same condition 
+            for a factor is loaded simultanously to the 384-well plates. 
+            Input is the level-to-wells index of the design, with the wells of every level
+            in the order of their dispense path from plan_level_paths()."""
+
+            for i, factor in enumerate(factors):
+                if factor["viscous"]:
+                    pipette_viscious(1)  # ON
+                for j, conc in enumerate(level_wells[factor["name"]]):
+                    conc_i_wells = level_wells[factor["name"]][conc]
+                    if not conc_i_wells:
+                        continue
+                    dil_well = "{}{}".format("ABCDEFGH"[i], j+2)
+                    transfer_combinations_of_small_vol_to_well(conc_i_wells, pcrtubes_cool.wells_by_name()[dil_well], factor["well_vol"])
+                if factor["viscous"]:
+                    pipette_viscious(0)  # OFF
+
+        # Record the calls of the liquid-handling helpers, see traced()
+        (multi_dispense, dispense_volumes, transfer_small_vol_to_well, transfer_combinations_of_small_vol_to_well,
+         make_single_dilution, make_control_dilutions, load_control, add_MQ, add_reagent, make_intermediate, factors_dilution, cool_down,
+         share_dilutions, cfe_mastermix, load_mastermix, load_blocks, load_combinations) = [traced(protocol, helper) for helper in (
+            multi_dispense, dispense_volumes, transfer_small_vol_to_well, transfer_combinations_of_small_vol_to_well,
+            make_single_dilution, make_control_dilutions, load_control, add_MQ, add_reagent, make_intermediate, factors_dilution, cool_down,
+            share_dilutions, cfe_mastermix, load_mastermix, load_blocks, load_combinations)]
+
+        protocol.comment("Phase: dilution")
+        if make_dilutions:
+            factors_dilution(plans)
+        if aliquots:
+            protocol.comment("Phase: aliquots")
+            share_dilutions(plans)
+
+        # Prepare buffer mix excl. factors for optimization
+        protocol.comment("Phase: cooling")
+        cool_down()
+        protocol.comment("Phase: mastermix")
+        cfe_mastermix()
 
+        if scheduler == "sequential":
+            load_mastermix(loaded_wells)
+            right_tips.drop()
+
+            # Load control wo/ DNA and reference concentration for all factors
+            protocol.comment("Phase: control")
+            make_control_dilutions(level_wells, plans)
+            load_control(level_wells, control_wells)
+
+            # Load combinations of factors
+            protocol.comment("Phase: combinations")
+            load_combinations(level_paths)
+
+            # Add DNA to initiate cell-free expression
+            protocol.comment("Phase: DNA")
+            transfer_small_vol_to_well(sorted(dna_wells), DNA)
+        else:
+            # Load the mastermix, the factors into it and the DNA block by block
+            protocol.comment("Phase: control")
+            make_control_dilutions(level_wells, plans)
+            load_blocks(blocks, block_paths, level_wells)
+        protocol.comment("Gantry travel between wells: {:.0f} mm unplanned, {:.0f} mm planned".format(*travel))
 
     ## Protocol workflow
     
+    if scheduler not in ("sequential", "blocks"):
+        raise ValueError("Error: Unknown scheduler {}. Use sequential or blocks.".format(scheduler))
+
     # Dilute factors
-    factor_dict = {"Mg-glutamate": Mg_final_conc, "K-glutamate": K_final_conc, "PEG-8000":P_final_conc}
-    factors = pd.DataFrame (factor_dict)
-    (p20_st,p300_st) = factors_dilution(factors,Mg_stock_conc,K_stock_conc,P_stock_conc,p20_st,p300_st)
+    factor_dict = {factor["name"]: factor["final_conc"] for factor in factors}
+    level_wells = index_level_wells(read_design(design)[1], factor_dict)
+    max_vol = 300 if p300 is not None else 20
+    plans = {}
+    for factor in factors:
+        counts = {conc: len(wells) for conc, wells in level_wells[factor["name"]].items()}
+        shares = aliquot_vols.get(factor["name"], [level_volumes(factor, counts)] * len(aliquots))
+        if len(shares) != len(aliquots) or any(len(share) != len(counts) for share in shares):
+            raise ValueError("Error: aliquot_vols of {} needs a volume of each of the {} final concentrations for each of the {} aliquot_slots.".format(
+                factor["name"], len(counts), len(aliquots)))
+        plans[factor["name"]] = plan_dilution(factor, counts, max_vol, shares)
+    if not make_dilutions:
+        # The dilutions are an aliquot from another robot, of the volumes it needs
+        for i, factor in enumerate(factors):
+            plan = plans[factor["name"]]
+            if plan["control"] is not None and plan["control"][0] == "intermediate":
+                raise ValueError("Error: The control dilution of {} needs an intermediate stock, which is only made with make_dilutions.".format(factor["name"]))
+            for (well, vol) in zip(pcrtubes_cool.rows()[i][1:], plan["level_vols"]):
+                liquid.load(well, vol, "{} dilution".format(factor["name"]))
+    # Stop before any liquid handling if the stocks do not hold the dilutions
+    short = []
+    for factor in factors:
+        needed = stock_needed(plans[factor["name"]])
+        if make_dilutions and needed > factor["stock_vol"] + 1e-6:
+            short.append("{:.1f} muL {} in {} (stock_vol {} muL{})".format(needed, factor["name"], stocks[factor["name"]].well_name, factor["stock_vol"],
+                         ", more than fits in the tube" if needed > stocks[factor["name"]].max_volume else ""))
+    if short:
+        raise ValueError("Error: The dilutions need more stock than there is: {}. Raise stock_vol, or use a smaller design or fewer replicates.".format(", ".join(short)))
+    for factor in factors:
+        plan = plans[factor["name"]]
+        if plan["intermediate"] and make_dilutions:
+            protocol.comment("{} intermediate stock: {} muL diluted {} times in {}".format(
+                factor["name"], plan["intermediate"]["vol"], plan["intermediate"]["ratio"], intermediates[factor["name"]].well_name))
+        if plan["dil_vol"] != factor["dil_vol"] and make_dilutions:
+            protocol.comment("{} dilutions: {} muL instead of dil_vol".format(factor["name"], plan["dil_vol"]))
 
-    # Prepare and load buffer mix excl. factors for optimization
-    p300_st = cfe_mastermix(p300_st)
+    # Plan the dispense paths of the combinations once, for the whole plate or block by block
+    if scheduler == "sequential":
+        (level_paths, travel) = plan_level_paths(level_wells)
+    else:
+        blocks = loading_blocks()
+        block_paths = []
+        travel = (0, 0)
+        for block in blocks:
+            in_block = set(block)
+            (level_paths, block_travel) = plan_level_paths({name: {conc: [well_no for well_no in wells if well_no in in_block] for conc, wells in levels.items()}
+                                                            for name, levels in level_wells.items()})
+            block_paths.append(level_paths)
+            travel = tuple(a + b for a, b in zip(travel, block_travel))
 
-    # Load control wo/ DNA and reference concentration for all factors
-    p20_st = load_control(factors,p20_st)
+    # Count the tips of the workflow in a dry run, with stand-ins for the protocol, modules and
+    # pipettes and fresh tip trackers, and check that the tip racks hold them before any
+    # liquid is handled
+    dry = DryRun()
+    (dry_p20, dry_p300, dry_p300m) = (DryPipette(pipette) if pipette is not None else None for pipette in (p20, p300, p300m))
+    dry_tips = (TipTracker(dry, dry_p20, tips20), TipTracker(dry, dry_p300 or dry_p300m, right_racks))
+    workflow(dry, dry, dry, dry_p20, dry_p300, dry_p300m, *dry_tips)
+    tips_needed = [tips.used for tips in dry_tips]
+    liquid.reset()
+    trace_calls.clear()
+    for tips, needed, racks in zip((p20_tips, right_tips), tips_needed, (tips20, right_racks)):
+        if needed > len(tips.tips) * (1 + max_tiprack_refills):
+            raise ValueError("Error: Design needs {} tips for {}, but {} tip racks with {} refills only hold {}. Add tip rack slots or refills.".format(
+                needed, tips.pipette.name, len(racks), max_tiprack_refills, len(tips.tips) * (1 + max_tiprack_refills)))
+        protocol.comment("Tips needed for {}: {}".format(tips.pipette.name, needed))
 
-    # Load combinations of factors
-    p20_st = load_combinations(factors, p20_st)
-    
-    # Add DNA to initiate cell-free expression
-    transfer_small_vol_to_well(0, nsamples, DNA, p20_st)
+    workflow(protocol, temp_module_pcrtubes, temp_module_eppendorftubes, p20, p300, p300m, p20_tips, right_tips)
+
+    # Stop the protocol analysis if a starting volume is too small
+    liquid.check()
+
+    if trace_file and not protocol.is_simulating():
+        write_trace(trace_file)
 
     #temp_module_pcrtubes.deactivate()
     #temp_module_eppendorftubes.deactivate()
@@ -1,13 +1,18 @@
 from opentrons import protocol_api
+import json
+import math
 import sys
+import time
 
 metadata = {
     'apiLevel': '2.8',
     'protocolName': 'Cell Free expression titration curve',
     'description': '''This protocol is designed to set up a logarithmic serial 
-    dilution of a single reagent for cell-free expression. A total of 7 
-    concentrations of the reagent are tested in technical triplicates, including
-    an internal control without DNA and the highest concentration.''',
+    dilution of one or more reagents for cell-free expression. A total of 7 
+    concentrations of each reagent are tested in technical triplicates in a row
+    of the plate, including an internal control without DNA and the highest
+    concentration. All rows share one master mix, and each row gets its master mix,
+    reagent and DNA before the next row is loaded.''',
     'author': 'Karen Therkelsen (s173684@dtu.dk)',
 }
 
@@ -15,15 +20,208 @@ metadata = {
 #                                  User inputs                                 #
 ################################################################################
 
-# Define row in well-plate to load
-row = "A"
+# Rows in the well-plate to load, one for each reagent to titrate (max. 16).
+# The reagent for the first row is placed in A1 of the PCR strips, the reagent
+# for the second row in A2, and so on. The reagents for rows 13-16 are placed in
+# A1-A4 of the PCR strips on a third temperature module in extra_strips_slot.
+rows = ["A"]
+extra_strips_slot = 1
+
+# Starting volumes (muL) in the Eppendorf module for each row to load, and of the
+# reagent to titrate in each PCR strip. The protocol analysis fails when the rows
+# need more than these. Lysate and buffer that do not fit in one tube are split
+# evenly over the tubes below it.
+start_volumes = {"MilliQ": 90, "DNA": 15, "rNTP": 18, "Lysate": 150, "Buffer": 175, "Reagent": 10}
+
+# Deck slots for tip racks. When all racks of a pipette are empty the protocol pauses
+# so they can be replaced with full racks, at most max_tiprack_refills times. The
+# protocol analysis fails when the rows need more tips than these.
+p20_tip_slots = [8, 7]
+p300_tip_slots = [9]
+max_tiprack_refills = 0
+
+# Write the calls of the liquid-handling helpers with their wall time as a Chrome trace
+# to this file when the protocol runs on the robot, e.g. "/data/user_storage/trace.json".
+# simulate.py --trace writes the trace of a simulated run.
+trace_file = None
 
 ################################################################################
 
+# Number of samples in each row
 nsamples = 8 * 3
 
+################################################################################
+#                              Multi-dispensing                                #
+################################################################################
+
+def plan_fills(nwells, vol, max_vol=20, disposal_vol=1):
+    """Split a multi-dispense of vol to nwells into as few fills of the pipette as
+    possible. Each fill holds the disposal volume on top of the dispensed volume.
+    Returns the number of wells dispensed to from each fill."""
+    wells_pr_fill = int((max_vol - disposal_vol) / vol + 1e-9)
+    if wells_pr_fill < 1:
+        raise ValueError("Error: {} muL plus {} muL disposal volume exceeds the pipette volume of {} muL.".format(vol, disposal_vol, max_vol))
+    return [min(wells_pr_fill, nwells - i) for i in range(0, nwells, wells_pr_fill)]
+
+################################################################################
+#                               Liquid tracking                                #
+################################################################################
+
+class LiquidTracker:
+    """Keeps track of the liquid in the tubes that are aspirated from. The liquid height
+    is estimated from the volume as if the tube had straight walls, which is at or below
+    the meniscus in tubes with a conical bottom. Aspirations follow the meniscus,
+    immersion mm below it, so they can run at full flow rate. A tube that runs dry is
+    recorded, and check() reports the starting volumes needed."""
+
+    def __init__(self, immersion=2, min_height=1):
+        self.immersion = immersion
+        self.min_height = min_height
+        self.volumes = {}
+        self.start = {}
+        self.lowest = {}
+        self.names = {}
+
+    def load(self, well, volume, name):
+        """Set the starting volume of a liquid, which is 0 for liquids prepared by the protocol."""
+        if volume > well.max_volume:
+            raise ValueError("Error: {} muL {} does not fit in {} of {} muL.".format(volume, name, well, well.max_volume))
+        self.volumes[well] = volume
+        self.start[well] = volume
+        self.lowest[well] = volume
+        self.names[well] = name
+
+    def height(self, well):
+        """Liquid height in mm above the bottom of a well."""
+        depth = well.top().point.z - well.bottom().point.z
+        return max(self.volumes.get(well, 0), 0) * depth / well.max_volume
+
+    def add(self, well, volume):
+        """Add a volume to a well."""
+        self.volumes[well] = self.volumes.get(well, 0) + volume
+        if self.volumes[well] > well.max_volume + 1e-6:
+            raise ValueError("Error: {:.1f} muL {} overflows {} of {} muL.".format(self.volumes[well], self.names.get(well, "liquid"), well, well.max_volume))
+
+    def take(self, well, volume):
+        """Remove a volume from a well and return the location to aspirate it from,
+        immersed below the meniscus that is left after the aspiration."""
+        self.add(well, -volume)
+        self.lowest[well] = min(self.lowest.get(well, 0), self.volumes[well])
+        return well.bottom(max(self.min_height, self.height(well) - self.immersion))
+
+    def check(self):
+        """Raise an error listing the liquids that ran out, with the volume missing. Protocol
+        analysis runs the whole protocol, so this stops the run before the robot moves."""
+        short = ["{:.1f} muL more {} in {}".format(-lowest, self.names.get(well, "liquid"), well)
+                 for well, lowest in self.lowest.items() if lowest < -1e-6]
+        if short:
+            raise ValueError("Error: The titration needs more liquid than there is: {}.".format(", ".join(short)))
+
+class TipTracker:
+    """Hands out tips to a pipette from its tip racks. A tip is picked up for a source
+    liquid, and a tip released with keep() is returned to its rack and reused the next
+    time the same source is pipetted. When all racks are empty the protocol pauses so
+    they can be replaced with full racks. An 8-channel pipette takes a column of tips."""
+
+    def __init__(self, protocol, pipette, racks):
+        self.protocol = protocol
+        self.pipette = pipette
+        if "multi" in pipette.name:
+            self.tips = [tip for rack in racks for tip in rack.rows()[0]]
+        else:
+            self.tips = [tip for rack in racks for tip in rack.wells()]
+        self.next_tip = 0
+        self.kept = {}
+        self.source = None
+        self.tip = None
+        self.used = 0
+
+    def pick_up(self, source):
+        """Pick up the tip kept for source, or else a new tip."""
+        if source in self.kept:
+            self.tip = self.kept.pop(source)
+        else:
+            if self.next_tip == len(self.tips):
+                self.protocol.pause("Replace the empty tip racks of {} with full racks.".format(self.pipette.name))
+                self.pipette.reset_tipracks()
+                self.next_tip = 0
+                self.kept = {}
+            self.tip = self.tips[self.next_tip]
+            self.next_tip += 1
+            self.used += 1
+        self.pipette.pick_up_tip(self.tip)
+        self.source = source
+
+    def keep(self):
+        """Return the tip to its rack for reuse with the same source."""
+        self.pipette.return_tip()
+        self.kept[self.source] = self.tip
+
+    def drop(self):
+        """Drop the tip in the trash."""
+        self.pipette.drop_tip()
+
+    def check(self, racks):
+        """Raise an error when the pipette used more tips than the racks hold with the
+        refills allowed. Protocol analysis runs the whole protocol, so this stops the run
+        before the robot moves."""
+        if self.used > len(self.tips) * (1 + max_tiprack_refills):
+            raise ValueError("Error: The titration needs {} tips for {}, but {} tip racks with {} refills only hold {}. Add tip rack slots or refills.".format(
+                self.used, self.pipette.name, len(racks), max_tiprack_refills, len(self.tips) * (1 + max_tiprack_refills)))
+
+################################################################################
+#                               Instrumentation                                #
+################################################################################
+
+# Calls of the liquid-handling helpers of run(), recorded by traced(). Each call has the
+# name of the helper, its wall time (s) and the range of the protocol commands it issued.
+trace_calls = []
+
+def traced(protocol, function):
+    """Wrap a helper of run() so that its calls are recorded in trace_calls."""
+    def wrapper(*args, **kwargs):
+        call = {"name": function.__name__, "start": time.monotonic(), "first_command": len(protocol.commands())}
+        trace_calls.append(call)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            call.update(end=time.monotonic(), last_command=len(protocol.commands()))
+    return wrapper
+
+def write_trace(path):
+    """Write the traced calls as a Chrome trace (chrome://tracing, Perfetto or speedscope)
+    with their wall time and number of protocol commands."""
+    start = min([call["start"] for call in trace_calls], default=0)
+    events = [{"name": call["name"], "ph": "X", "pid": 1, "tid": 1, "ts": (call["start"] - start) * 1e6,
+               "dur": (call["end"] - call["start"]) * 1e6, "args": {"commands": call["last_command"] - call["first_command"]}}
+              for call in trace_calls if "end" in call]
+    with open(path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+################################################################################
+#                                   Plate map                                  #
+################################################################################
+
+def plate_map():
+    """Content of every loaded well: deck slot and name of the well, its row, the PCR
+    strip tube of the reagent with its dilution step (10-fold per step) and concentration
+    relative to the reagent, and whether it is the internal control and gets DNA. The
+    last 3 wells of each row are the internal control without DNA."""
+    wells = []
+    for n, row in enumerate(rows):
+        for i in range(nsamples):
+            control = i >= nsamples - 3
+            step = 0 if control else i // 3
+            wells.append({"slot": 11, "well": "{}{}".format(row, i + 1), "row": row,
+                          "reagent_slot": 10 if n < 12 else extra_strips_slot,
+                          "reagent": "{}{}".format("ABCDEFGH"[step], n % 12 + 1), "dilution_step": step,
+                          "relative_conc": 10.0 ** -step, "control": control, "DNA": not control})
+    return wells
+
+################################################################################
 
 def run(protocol):
+    trace_calls.clear()
     
     ## Load instrument, modules and labware ##
 
@@ -31,120 +229,233 @@ def run(protocol):
     # PCR strips,  #   384-well   #    Trash     #
     # 4C   	       #   plate      #              #
     #--------------#--------------#--------------#
-    #              #   P20 tips   #  P300 tips   #
+    #   P20 tips   #   P20 tips   #  P300 tips   #
     #              #              #              #
     #------------- #------------- #------------- #
-    # 2mLEppendorf #              #              #
-    # tubes, 4C    #              #              #
+    # 2mLEppendorf # 15mL falcon  #              #
+    # tubes, 4C    # rack (more   #              #
+    #              # than 6 rows) #              #
     #------------- #------------- #------------- #
-    #              #              #              #
-    #              #              #              #
+    # PCR strips   #              #              #
+    # rows 13-16,  #              #              #
+    # 4C           #              #              #
     #------------- #------------- #------------- #
 
 
     # Pipettes and tips
-    tips20 = protocol.load_labware('opentrons_96_tiprack_20ul', 8)
-    tips300 = protocol.load_labware('opentrons_96_tiprack_300ul', 9)
-    p20 = protocol.load_instrument('p20_single_gen2', mount='left', tip_racks=[tips20])
-    p300 = protocol.load_instrument('p300_single', mount='right', tip_racks=[tips300])
+    tips20 = [protocol.load_labware('opentrons_96_tiprack_20ul', slot) for slot in p20_tip_slots]
+    tips300 = [protocol.load_labware('opentrons_96_tiprack_300ul', slot) for slot in p300_tip_slots]
+    p20 = protocol.load_instrument('p20_single_gen2', mount='left', tip_racks=tips20)
+    p300 = protocol.load_instrument('p300_single', mount='right', tip_racks=tips300)
+    p20_tips = TipTracker(protocol, p20, tips20)
+    p300_tips = TipTracker(protocol, p300, tips300)
 
     # 384-well plate
     plate = protocol.load_labware('corning_384_wellplate_112ul_flat', 11)
+    if len(rows) > 16:
+        raise ValueError("Error: Max. 16 reagents fit in the rows of the plate.")
 
     # Temperature modules
     temp_module_pcrtubes = protocol.load_module('temperature module gen2', 10)
     pcrtubes_cool = temp_module_pcrtubes.load_labware('opentrons_96_aluminumblock_generic_pcr_strip_200ul')
+    temp_module_pcrtubes.start_set_temperature(4)
 
     temp_module_eppendorftubes = protocol.load_module('temperature module gen2', 4)
     eppendorftubes_cool = temp_module_eppendorftubes.load_labware('opentrons_24_aluminumblock_nest_2ml_snapcap')
-    
+    temp_module_eppendorftubes.start_set_temperature(4)
+
+    # PCR strips of rows 13-16 on a third temperature module
+    if len(rows) > 12:
+        temp_module_extra_strips = protocol.load_module('temperature module gen2', extra_strips_slot)
+        extra_strips_cool = temp_module_extra_strips.load_labware('opentrons_96_aluminumblock_generic_pcr_strip_200ul')
+        temp_module_extra_strips.start_set_temperature(4)
+        temp_modules = [temp_module_pcrtubes, temp_module_eppendorftubes, temp_module_extra_strips]
+    else:
+        temp_modules = [temp_module_pcrtubes, temp_module_eppendorftubes]
+
+    # The modules ramp while the serial dilution is made, and cool_down() waits for
+    # them before the lysate and DNA are handled.
 
     ## Define start reagents
     
     # In PCR module (number refer to well)
-    # A1. X: 10 uL
-    # B1-H1: empty tubes
-    # A2. DNA: 15 uL
-    # B2. rNTP: 18 uL
-    # C2. Lysate: 150 uL
-    # D2. Buffer: 175 uL
-    X = pcrtubes_cool.wells()[0]
-    DNA = pcrtubes_cool.wells()[8]
-    rNTP = pcrtubes_cool.wells()[9]
-    Lysate = pcrtubes_cool.wells()[10]
-    Buffer = pcrtubes_cool.wells()[11]
+    # A1. X: 10 uL, reagent for the first row
+    # B1-G1: empty tubes
+    # A2, A3, ...: reagents for the next rows, with empty tubes below
+    # Rows 13-16 continue in A1-A4 of the PCR strips in extra_strips_slot.
+    reagent_columns = pcrtubes_cool.columns()
+    if len(rows) > 12:
+        reagent_columns += extra_strips_cool.columns()
+    reagent_columns = reagent_columns[:len(rows)]
 
     # In Eppendorf module
-    # A1. MQ: 1 mL
-    # A2. MM: 1 mL
+    # A1. MQ: 90 uL per row
+    # B1. DNA: 15 uL per row
+    # B2. rNTP: 18 uL per row
+    # B3. Lysate: 150 uL per row, continued in C3 and D3 when it does not fit
+    # B4. Buffer: 175 uL per row, continued in C4 and D4 when it does not fit
+    # A2. MM: empty tube for the mastermix of up to 6 rows
     MQ = eppendorftubes_cool.wells_by_name()["A1"]
+    DNA = eppendorftubes_cool.wells_by_name()["B1"]
+    rNTP = eppendorftubes_cool.wells_by_name()["B2"]
+    Lysate = eppendorftubes_cool.columns()[2][1:]
+    Buffer = eppendorftubes_cool.columns()[3][1:]
+    for (tubes, name) in ((Lysate, "Lysate"), (Buffer, "Buffer")):
+        tubes[:] = tubes[:math.ceil(start_volumes[name] * len(rows) / tubes[0].max_volume - 1e-9)]
+
+    # The mastermix is kept cool in A2 of the Eppendorf module when it fits in the tube,
+    # and else made in an empty 15 mL falcon in A1 of the tube rack
+    mastermix_vol = (4 + 4.5 + 0.5) * len(rows) * nsamples * 1.5  #uL
     MM = eppendorftubes_cool.wells_by_name()["A2"]
+    if mastermix_vol > MM.max_volume:
+        rack = protocol.load_labware('opentrons_15_tuberack_falcon_15ml_conical', 5)
+        MM = rack.wells_by_name()["A1"]
+
+    # Volumes of the reagents, checked against the rows by liquid.check()
+    liquid = LiquidTracker()
+    for (well, name) in ((MQ, "MilliQ"), (DNA, "DNA"), (rNTP, "rNTP")):
+        liquid.load(well, start_volumes[name] * len(rows), name)
+    for (tubes, name) in ((Lysate, "Lysate"), (Buffer, "Buffer")):
+        for tube in tubes:
+            liquid.load(tube, start_volumes[name] * len(rows) / len(tubes), name)
+    for row, column in zip(rows, reagent_columns):
+        liquid.load(column[0], start_volumes["Reagent"], "reagent of row {}".format(row))
+        for tube in column[1:7]:
+            liquid.load(tube, 0, "dilution of row {}".format(row))
+    liquid.load(MM, 0, "mastermix")
 
 
     ## Functions
 
     def serial_dilution():
-        """Prepare logaritmic serial dilution with reagent"""
-        p20.distribute(9, MQ, pcrtubes_cool.wells()[1:7])
-        p20.pick_up_tip()
-        p20.transfer(1, pcrtubes_cool.wells()[:6], pcrtubes_cool.wells()[1:7], mix_after=(10,8), new_tip="never")
-        p20.drop_tip()
+        """Prepare logaritmic serial dilution with every reagent. The MilliQ is
+        distributed to the tubes of all reagents with one tip."""
+        tubes = [tube for column in reagent_columns for tube in column[1:7]]
+        # The disposal volume of every fill is blown out in the trash
+        p20_tips.pick_up(MQ)
+        p20.distribute(9, liquid.take(MQ, 9 * len(tubes) + p20.min_volume * len(plan_fills(len(tubes), 9, p20.max_volume, p20.min_volume))), tubes, new_tip="never")
+        p20_tips.drop()
+        for tube in tubes:
+            liquid.add(tube, 9)
+        for column in reagent_columns:
+            sources = []
+            for (source, dest) in zip(column[:6], column[1:7]):
+                sources.append(liquid.take(source, 1))
+                liquid.add(dest, 1)
+            p20_tips.pick_up(column[0])
+            p20.transfer(1, sources, column[1:7], mix_after=(10,8), new_tip="never")
+            p20_tips.drop()
+
+    def cool_down():
+        """Wait for the temperature modules to reach 4C."""
+        for temp_module in temp_modules:
+            temp_module.await_temperature(4)
 
     def mix_mastermix():
         """Ensure homogenous mastermix before loding"""
-        p300.pick_up_tip()
+        p300_tips.pick_up(MM)
         for i in range(5):
-            p300.aspirate(100, MM.bottom(1))
-            p300.dispense(100, MM.top(-20))
-        p300.drop_tip()
+            p300.aspirate(100, liquid.take(MM, 100))
+            liquid.add(MM, 100)
+            p300.dispense(100, MM.bottom(liquid.height(MM)))
+        p300_tips.drop()
      
     def cfe_mastermix_prep():
-        """Prepare CFE master mix excl. reagent"""
-        lysate_vol = 4 * (nsamples * 1.5) #uL
-        buffer_vol = 4.5 * (nsamples * 1.5)  #uL
-        rNTP_vol = 0.5 * (nsamples * 1.5)  #uL
-
-        p300.transfer(lysate_vol, Lysate, MM, touch_tip=True)
-        p300.transfer(buffer_vol, Buffer, MM, touch_tip=True)
-        p20.transfer(rNTP_vol, rNTP, MM, touch_tip=True)
-    
-    def dispense_small_vol_to_well(well_start, well_stop, reagent):
-        "Liquid handling of 0.5 uL to well-plate to a range of destination well numbers."
-        p20.pick_up_tip()
-        total_vol = ((well_stop - well_start) * 0.5) + 1
-        p20.aspirate(total_vol, reagent.bottom(1))
-        for well_no in range(well_start, well_stop):
-            p20.dispense(0.5, plate.rows_by_name()[row][well_no].bottom(0.1))
-        p20.drop_tip()
-    
+        """Prepare CFE master mix excl. reagent for all rows"""
+        lysate_vol = 4 * (len(rows) * nsamples * 1.5) #uL
+        buffer_vol = 4.5 * (len(rows) * nsamples * 1.5)  #uL
+        rNTP_vol = 0.5 * (len(rows) * nsamples * 1.5)  #uL
+
+        for (tubes, vol) in ((Lysate, lysate_vol), (Buffer, buffer_vol)):
+            p300_tips.pick_up(tubes[0])
+            for tube in tubes:
+                p300.transfer(vol / len(tubes), liquid.take(tube, vol / len(tubes)), MM, touch_tip=True, new_tip="never")
+            p300_tips.drop()
+        p20_tips.pick_up(rNTP)
+        p20.transfer(rNTP_vol, liquid.take(rNTP, rNTP_vol), MM, touch_tip=True, new_tip="never")
+        p20_tips.drop()
+        liquid.add(MM, lysate_vol + buffer_vol + rNTP_vol)
     
+    def multi_dispense(pipette, vol, reagent, wells, disposal_vol=1):
+        """Dispense the same volume of reagent to a list of wells with as few fills of
+        the pipette as possible. The disposal volume is blown out back into the reagent
+        before the pipette is filled again."""
+        fills = plan_fills(len(wells), vol, pipette.max_volume, disposal_vol)
+        for i, nwells in enumerate(fills):
+            if i > 0 or pipette.current_volume > 0:
+                liquid.add(reagent, pipette.current_volume)
+                pipette.blow_out(reagent)
+            pipette.aspirate(nwells * vol + disposal_vol, liquid.take(reagent, nwells * vol + disposal_vol))
+            for well in wells[:nwells]:
+                pipette.dispense(vol, well.bottom(0.1))
+            wells = wells[nwells:]
+
+    def dispense_small_vol_to_well(wells, reagent, keep=False):
+        """Liquid handling of 0.5 uL to well-plate to a list of destination wells. With keep
+        the disposal volume is blown out back into the reagent and the tip is returned to
+        its rack for the next row."""
+        p20_tips.pick_up(reagent)
+        multi_dispense(p20, 0.5, reagent, wells)
+        if keep:
+            liquid.add(reagent, p20.current_volume)
+            p20.blow_out(reagent)
+            p20_tips.keep()
+        else:
+            p20_tips.drop()
+
+    def load_mastermix(wells):
+        """Load 9 uL mastermix to a list of wells, and return the tip to its rack for the next row."""
+        p20_tips.pick_up(MM)
+        p20.distribute(9.0, liquid.take(MM, 9.0 * len(wells)), wells, touch_tip=True, blow_out=True, blowout_location='source well', new_tip="never")
+        p20_tips.keep()
+
+    def load_row(row, column):
+        """Load the mastermix, the serial dilution of the reagent, the internal control
+        and the DNA to a row, so the DNA follows shortly after the mastermix."""
+        protocol.comment("Phase: mastermix")
+        load_mastermix(plate.rows_by_name()[row][:nsamples])
+        protocol.comment("Phase: reagent")
+        for i in range(0,nsamples-3,3):
+            dil_no = int((i+1)/3)
+            wells = plate.rows_by_name()[row][i:i+3]
+            if dil_no == 0:
+                # Load internal control
+                wells += plate.rows_by_name()[row][nsamples-3:nsamples]
+            dispense_small_vol_to_well(wells, column[dil_no])
+        dispense_small_vol_to_well(plate.rows_by_name()[row][nsamples-3:nsamples], MQ, keep=True)
+
+        # Add DNA to initate CFE
+        protocol.comment("Phase: DNA")
+        dispense_small_vol_to_well(plate.rows_by_name()[row][:nsamples-3], DNA, keep=True)
+
+
+    # Record the calls of the liquid-handling helpers, see traced()
+    (serial_dilution, cool_down, mix_mastermix, cfe_mastermix_prep, multi_dispense, dispense_small_vol_to_well, load_mastermix, load_row) = [traced(protocol, helper) for helper in (
+        serial_dilution, cool_down, mix_mastermix, cfe_mastermix_prep, multi_dispense, dispense_small_vol_to_well, load_mastermix, load_row)]
 
     ## Protocol workflow
     
-    #temp_module_pcrtubes.set_temperature(4)
-    #temp_module_eppendorftubes.set_temperature(4)
-    
     # Prepare master mix and serial dilution
+    protocol.comment("Phase: dilution")
     serial_dilution()
+    protocol.comment("Phase: cooling")
+    cool_down()
+    protocol.comment("Phase: mastermix")
     cfe_mastermix_prep()
     
-    # Add Add mastermix
     mix_mastermix()
-    p20.distribute(9.0, MM, plate.rows_by_name()[row][:nsamples], touch_tip=True, blow_out=True, blowout_location='source well')
-    
-    # Add reagent
-    for i in range(0,nsamples-3,3):
-        dil_no = int((i+1)/3)
-        if dil_no == 0:
-            dispense_small_vol_to_well(i, i+3, pcrtubes_cool.wells()[dil_no])
-            # Load internal control
-            dispense_small_vol_to_well(nsamples-3, nsamples, pcrtubes_cool.wells()[dil_no])
-            dispense_small_vol_to_well(nsamples-3, nsamples, MQ) 
-        else:
-            dispense_small_vol_to_well(i, i+3, pcrtubes_cool.wells()[dil_no])
 
-    # Add DNA to initate CFE
-    dispense_small_vol_to_well(0, nsamples-3, DNA)
+    # Load the plate row by row
+    for row, column in zip(rows, reagent_columns):
+        load_row(row, column)
+
+    # Stop the protocol analysis if a starting volume is too small or the tips run out
+    liquid.check()
+    p20_tips.check(tips20)
+    p300_tips.check(tips300)
+
+    if trace_file and not protocol.is_simulating():
+        write_trace(trace_file)
     
     #temp_module_pcrtubes.deactivate()
     #temp_module_eppendorftubes.deactivate()
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""Split the design of a buffer optimization over several OT-2 robots.
+
+The conditions of the design in cfe_buffer_optimization.py are dealt out to the robots
+in turn, so every robot gets the same number of conditions (+-1) in the randomised order
+of the design, and its own internal control. Every robot makes the dilutions of its
+conditions from its own stocks, so all robots start together.
+
+    python shard.py cfe_buffer_optimization.py --robots 3 --out shards
+
+With --share-dilutions the first robot makes the dilutions for all robots from one set
+of stocks and dispenses an aliquot of each into PCR strips in free deck slots. These are
+moved onto the temperature modules of the other robots, which start from the aliquots.
+The other robots wait for the dilutions and aliquots of the first robot, so more robots
+shorten the run less, and the stocks and max_dil_vol of the first robot limit the design.
+
+One protocol per robot and a plate map of all robots are written to the output
+directory. The estimated start and end of every robot are printed. The exit status is 1
+when the simulation of any robot fails.
+"""
+import argparse
+import json
+import os
+import re
+import sys
+
+from simulate import load_protocol, simulate, summarize, write_csv
+
+################################################################################
+#                                   Sharding                                   #
+################################################################################
+
+# Deck slots of the first robot that can hold the PCR strips of the aliquots, used in
+# this order when they hold no plate or tip rack
+free_slots = [1, 2, 3, 6, 7]
+
+################################################################################
+
+def shard_design(conditions, columns, nrobots):
+    """Deal the conditions of a design out to the robots in turn. Returns the
+    (conditions, columns) of every robot."""
+    return [(conditions[i::nrobots], {factor: values[i::nrobots] for factor, values in columns.items()}) for i in range(nrobots)]
+
+def design_text(conditions, columns):
+    """Design block of the protocol with one condition per line."""
+    lines = ["condition," + ",".join(columns)]
+    lines += ["{},{}".format(condition, ",".join("{:g}".format(columns[factor][i]) for factor in columns)) for i, condition in enumerate(conditions)]
+    return "\n".join(lines)
+
+def level_counts(module, factor, shard):
+    """Number of wells of a robot with each final concentration of a factor."""
+    (conditions, columns) = shard
+    return {conc: columns[factor["name"]].count(conc) * module.replicates for conc in sorted(factor["final_conc"])}
+
+def aliquot_vols(module, shards):
+    """Volumes of the aliquots of every factor that the first robot makes for the other
+    robots, with the volume each robot needs of every final concentration."""
+    return {factor["name"]: [[round(vol, 2) for vol in module.level_volumes(factor, level_counts(module, factor, shard))] for shard in shards[1:]]
+            for factor in module.factors}
+
+def check_stocks(module, shard, shares, robot):
+    """Raise an error when the stocks of a robot do not hold the dilutions it makes, for
+    itself and for the aliquots in shares, with the stock each factor needs."""
+    max_vol = 300 if module.pipette_mode == "single" else 20
+    short = []
+    for factor in module.factors:
+        plan = module.plan_dilution(factor, level_counts(module, factor, shard), max_vol, shares.get(factor["name"], []))
+        needed = module.stock_needed(plan)
+        if needed > factor["stock_vol"] + 1e-6:
+            short.append("{:.1f} muL {} in {} (stock_vol {} muL)".format(needed, factor["name"], factor["stock_well"], factor["stock_vol"]))
+    if short:
+        nrobots = 1 + max([len(volumes) for volumes in shares.values()], default=0)
+        raise ValueError("Error: Robot {} makes the dilutions of {} robot{} and needs more stock than there is: {}. Raise stock_vol{}.".format(
+            robot, nrobots, "s" if nrobots > 1 else "", ", ".join(short), " or use fewer robots" if nrobots > 1 else ""))
+
+def substitute(text, pattern, replacement, what, path):
+    (text, found) = re.subn(pattern, lambda m: m.group(1) + replacement, text, count=1, flags=re.M | re.S)
+    if not found:
+        raise ValueError("Error: {} has no {} to write the shard to.".format(path, what))
+    return text
+
+def write_shard(path, out_path, design, aliquot_slots, aliquot_vols, make_dilutions):
+    """Write a copy of the protocol with the design of one robot and the aliquot inputs."""
+    with open(path) as f:
+        text = f.read()
+    text = substitute(text, r'^(design = """\n).*?^(?=""")', design + "\n", "design block", path)
+    text = substitute(text, r"^(aliquot_slots = )[^\n]*$", str(aliquot_slots), "aliquot_slots", path)
+    text = substitute(text, r"^(aliquot_vols = )[^\n]*$", json.dumps(aliquot_vols), "aliquot_vols", path)
+    text = substitute(text, r"^(make_dilutions = )[^\n]*$", str(make_dilutions), "make_dilutions", path)
+    with open(out_path, "w") as f:
+        f.write(text)
+
+def aliquot_slots(module, nsamples, nrobots):
+    """Free deck slots of the first robot for the aliquots of the other robots."""
+    nplates = module.plate_positions(module.replicates * (nsamples + 1))[-1] // 384 + 1
+    used = set(module.plate_slots[:nplates]) | set(module.p20_tip_slots)
+    used |= set(module.p300_tip_slots if module.pipette_mode == "single" else module.multi_tip_slots)
+    slots = [slot for slot in free_slots if slot not in used]
+    if len(slots) < nrobots - 1:
+        raise ValueError("Error: The first robot has {} free deck slots for the aliquots of {} robots.".format(len(slots), nrobots - 1))
+    return slots[:nrobots - 1]
+
+def shard(path, nrobots, out, share_dilutions=False):
+    """Write the protocol of every robot and the plate map of all robots to out. Every robot
+    makes its own dilutions, or with share_dilutions the first robot makes them for all.
+    Returns the paths of the protocols."""
+    module = load_protocol(path)
+    (conditions, columns) = module.read_design(module.design)
+    if nrobots < 1 or nrobots > len(conditions):
+        raise ValueError("Error: {} conditions cannot be split over {} robots.".format(len(conditions), nrobots))
+    shards = shard_design(conditions, columns, nrobots)
+    shares = aliquot_vols(module, shards) if share_dilutions else {}
+    for robot, robot_shard in enumerate(shards, 1):
+        if robot == 1 or not share_dilutions:
+            check_stocks(module, robot_shard, shares if robot == 1 else {}, robot)
+    os.makedirs(out, exist_ok=True)
+    (stem, ext) = os.path.splitext(os.path.basename(path))
+    paths = []
+    plate_map = []
+    for robot, (robot_conditions, robot_columns) in enumerate(shards, 1):
+        out_path = os.path.join(out, "{}_robot{}{}".format(stem, robot, ext))
+        if robot == 1 and share_dilutions:
+            write_shard(path, out_path, design_text(robot_conditions, robot_columns), aliquot_slots(module, len(robot_conditions) + 1, nrobots), shares, True)
+        else:
+            write_shard(path, out_path, design_text(robot_conditions, robot_columns), [], {}, not share_dilutions)
+        plate_map += [dict(robot=robot, **well) for well in load_protocol(out_path).plate_map()]
+        paths.append(out_path)
+    write_csv(os.path.join(out, "plate_map.csv"), plate_map)
+    return paths
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Split the design of a buffer optimization over several OT-2 robots. "
+                                                 "Every robot makes its own dilutions from its own stocks, unless --share-dilutions is given.")
+    parser.add_argument("protocol", help="protocol with the design to split, e.g. cfe_buffer_optimization.py")
+    parser.add_argument("--robots", type=int, default=2, help="number of robots")
+    parser.add_argument("--out", default="shards", help="directory of the protocols and the plate map")
+    parser.add_argument("--share-dilutions", action="store_true",
+                        help="the first robot makes the dilutions of all robots from its stocks and the other robots start from its aliquots. "
+                             "They wait for the first robot, so more robots shorten the run less, and the stocks and max_dil_vol of the "
+                             "first robot must hold the dilutions of all robots")
+    args = parser.parse_args()
+
+    paths = shard(args.protocol, args.robots, args.out, args.share_dilutions)
+    print("{:<48}{:>12}{:>12}{:>12}{:>8}".format("Protocol", "Conditions", "Start (min)", "End (min)", "Tips"))
+    # With shared dilutions the other robots start from the aliquots, when the first robot
+    # has made them. The start is then unknown when the first robot fails.
+    ready = None if args.share_dilutions else 0
+    failed = False
+    for robot, out_path in enumerate(paths, 1):
+        module = load_protocol(out_path)
+        nconditions = len(module.read_design(module.design)[0])
+        try:
+            summary = summarize(simulate(out_path))
+        except ValueError as error:
+            print("{:<48}{:>12}  {}".format(out_path, nconditions, error))
+            failed = True
+            continue
+        if robot == 1 and args.share_dilutions:
+            phases = list(summary["phases"])
+            if "aliquots" in phases:
+                ready = sum(summary["phases"][phase]["time"] for phase in phases[:phases.index("aliquots") + 1])
+            start = 0
+        else:
+            start = ready
+        if start is None:
+            print("{:<48}{:>12}{:>12}{:>12}{:>8}".format(out_path, nconditions, "-", "-", summary["total"]["tips"]))
+        else:
+            print("{:<48}{:>12}{:>12.1f}{:>12.1f}{:>8}".format(out_path, nconditions, start / 60, (start + summary["total"]["time"]) / 60, summary["total"]["tips"]))
+    print("Plate map of all robots written to {}".format(os.path.join(args.out, "plate_map.csv")))
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,715 @@
+#!/usr/bin/env python3
+"""Fast dry run of the OT-2 protocols in this repository with a timing model.
+
+The run(protocol) function of a protocol is called with a recording protocol
+context instead of the Opentrons one. Every aspirate, dispense, move and tip
+event is recorded, and the wall-clock time on the robot is estimated from the
+flow rates of the pipettes and the distances travelled by the gantry.
+
+    python simulate.py cfe_buffer_optimization.py cfe_titration_curve.py
+
+The protocols mark the start of each phase with a comment "Phase: <name>", and the
+estimated time is reported per phase. The time from the mastermix to the DNA is
+reported for every well that gets both. The plate map of the protocols and the
+recorded events with their start times can be saved as CSV files for the analysis
+of the plate-reader data. The calls of the liquid-handling helpers traced by the
+protocols can be saved as a Chrome trace (chrome://tracing, Perfetto or speedscope),
+with the recorded commands nested in the helpers on the estimated time of the run.
+
+Simulated runs are cached by the content of the protocol and simulate.py without
+comments, the replaced user inputs and the version of the labware definitions, so a
+run of an unchanged design is read from the cache instead of simulated again.
+"""
+import argparse
+import csv
+import hashlib
+import importlib.metadata
+import importlib.util
+import json
+import os
+import tokenize
+from collections import namedtuple
+from types import SimpleNamespace
+
+from opentrons_shared_data.labware import load_definition
+
+################################################################################
+#                                 Timing model                                 #
+################################################################################
+
+# Gantry speeds (mm/s)
+x_speed = 600
+y_speed = 400
+z_speed = 125
+
+# Clearance (mm) above the labware when moving between wells of the same labware,
+# and above the highest labware on the deck when moving between labware
+well_margin = 5
+labware_margin = 10
+
+# Duration (s) of the tip handling and other fixed pipette motions
+tip_pick_up_time = 3
+tip_drop_time = 2
+touch_tip_time = 2
+blow_out_time = 1
+
+# Ramp rate of the temperature modules (degC/s), starting from room temperature (degC)
+temp_ramp_rate = 0.04
+room_temp = 25
+
+################################################################################
+#                                     Cache                                    #
+################################################################################
+
+# Directory of the cached runs, and the number of runs kept. The least recently used
+# runs are removed beyond cache_size, and cache_size = 0 turns the cache off.
+cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".simulate_cache")
+cache_size = 64
+
+################################################################################
+
+# Pipettes: min. and max. volume (muL), default flow rates (muL/s) and channels
+PIPETTES = {
+    "p20_single_gen2": {"min_volume": 1, "max_volume": 20, "aspirate": 7.56, "dispense": 7.56, "blow_out": 7.56, "channels": 1},
+    "p300_single": {"min_volume": 30, "max_volume": 300, "aspirate": 150, "dispense": 300, "blow_out": 1000, "channels": 1},
+    "p20_multi_gen2": {"min_volume": 1, "max_volume": 20, "aspirate": 7.6, "dispense": 7.6, "blow_out": 7.6, "channels": 8},
+    "p300_multi_gen2": {"min_volume": 20, "max_volume": 300, "aspirate": 94, "dispense": 94, "blow_out": 94, "channels": 8},
+}
+
+# Distance between the channels of a multichannel pipette (mm)
+CHANNEL_PITCH = 9
+
+# Origin of the deck slots (mm)
+SLOTS = {slot: ((slot - 1) % 3 * 132.5, (slot - 1) // 3 * 90.5, 0) for slot in range(1, 13)}
+
+# Offset of labware loaded on a temperature module
+MODULE_OFFSET = (-1.45, -0.15, 80.09)
+
+# Top of the fixed trash in slot 12
+TRASH = (347.84, 351.5, 82)
+
+
+Point = namedtuple("Point", "x y z")
+
+
+class Location:
+    """A point in a well, in deck coordinates."""
+
+    def __init__(self, well, z):
+        self.well = well
+        self.point = Point(well.x, well.y, z)
+
+    def __repr__(self):
+        return "{} at z={:.1f}".format(self.well, self.point.z)
+
+
+def _well(location):
+    """The well of a location. Touch tips and blow-outs in a transfer are made at the
+    top of the well, also when the source or destination is a location in it."""
+    return location.well if isinstance(location, Location) else location
+
+
+class Well:
+    """A well of a labware, with its geometry from the labware definition."""
+
+    def __init__(self, parent, name, definition, origin):
+        self.parent = parent
+        self.well_name = name
+        self.x = origin[0] + definition["x"]
+        self.y = origin[1] + definition["y"]
+        self.z = origin[2] + definition["z"]
+        self.depth = definition["depth"]
+        self.max_volume = definition["totalLiquidVolume"]
+        self.diameter = definition.get("diameter")
+        self.geometry = definition
+
+    def bottom(self, z=0):
+        return Location(self, self.z + z)
+
+    def top(self, z=0):
+        return Location(self, self.z + self.depth + z)
+
+    def center(self):
+        return Location(self, self.z + self.depth / 2)
+
+    def __repr__(self):
+        return "{} of {}".format(self.well_name, self.parent)
+
+
+class Labware:
+    """A labware loaded from its Opentrons definition."""
+
+    def __init__(self, load_name, slot, origin):
+        definition = load_definition(load_name, 1)
+        self.load_name = load_name
+        self.slot = slot
+        origin = tuple(o + c for o, c in zip(origin, definition["cornerOffsetFromSlot"].values()))
+        self.height = origin[2] + definition["dimensions"]["zDimension"]
+        self._columns = [[Well(self, name, definition["wells"][name], origin) for name in column] for column in definition["ordering"]]
+        self._wells = [well for column in self._columns for well in column]
+
+    def wells(self):
+        return list(self._wells)
+
+    def wells_by_name(self):
+        return {well.well_name: well for well in self._wells}
+
+    def columns(self):
+        return [list(column) for column in self._columns]
+
+    def rows(self):
+        return [list(row) for row in zip(*self._columns)]
+
+    def rows_by_name(self):
+        return {row[0].well_name[0]: row for row in self.rows()}
+
+    def channel_wells(self, well, channels):
+        """Wells reached by the channels of a pipette with the first channel in well."""
+        column = next(column for column in self._columns if well in column)
+        return [other for other in column if any(abs(other.y - (well.y - k * CHANNEL_PITCH)) < 0.5 for k in range(channels))]
+
+    def __repr__(self):
+        return "{} on {}".format(self.load_name, self.slot)
+
+
+class TemperatureModule:
+    """A temperature module that ramps at temp_ramp_rate."""
+
+    def __init__(self, protocol, slot):
+        self.protocol = protocol
+        self.slot = slot
+        self.temperature = room_temp
+        self.target = None
+        self.ready_at = 0
+
+    def load_labware(self, load_name):
+        origin = tuple(s + o for s, o in zip(SLOTS[self.slot], MODULE_OFFSET))
+        return self.protocol._add_labware(Labware(load_name, self.slot, origin))
+
+    def start_set_temperature(self, celsius):
+        self.ready_at = self.protocol.time + abs(self.temperature - celsius) / temp_ramp_rate
+        self.temperature = self.target = celsius
+        self.protocol._record("start_set_temperature", volume=celsius)
+
+    def await_temperature(self, celsius):
+        self.protocol._record("await_temperature", duration=max(0, self.ready_at - self.protocol.time), volume=celsius)
+
+    def set_temperature(self, celsius):
+        self.start_set_temperature(celsius)
+        self.await_temperature(celsius)
+
+    def deactivate(self):
+        self.temperature = room_temp
+        self.target = None
+        self.protocol._record("deactivate")
+
+
+class Pipette:
+    """A pipette that records its commands in the protocol context. Liquid handling
+    takes the volume divided by the flow rate, and moves take the time of an arc from
+    the current position of the gantry."""
+
+    def __init__(self, protocol, name, mount, tip_racks):
+        self.protocol = protocol
+        self.name = name
+        self.mount = mount
+        self.tip_racks = tip_racks
+        spec = PIPETTES[name]
+        self.min_volume = spec["min_volume"]
+        self.max_volume = spec["max_volume"]
+        self.channels = spec["channels"]
+        self.flow_rate = SimpleNamespace(aspirate=spec["aspirate"], dispense=spec["dispense"], blow_out=spec["blow_out"])
+        self.well_bottom_clearance = SimpleNamespace(aspirate=1, dispense=1)
+        self.current_volume = 0
+        self.has_tip = False
+        self.tip = None
+        self.next_tip = 0
+
+    def _location(self, location, clearance):
+        if location is None:
+            return None
+        if isinstance(location, Well):
+            return location.bottom(clearance)
+        return location
+
+    def _command(self, command, location=None, duration=0, volume=None):
+        travel, move_time = self.protocol._move_to(location)
+        self.protocol._record(command, pipette=self, location=location, duration=move_time + duration, volume=volume, travel=travel)
+
+    def _wells(self, location):
+        if location is None:
+            return []
+        return [well.well_name for well in location.well.parent.channel_wells(location.well, self.channels)]
+
+    def pick_up_tip(self, location=None):
+        if location is None:
+            tips = [tip for rack in self.tip_racks for tip in rack.wells()]
+            if self.next_tip == len(tips):
+                raise ValueError("Error: {} has no tips left in its tip racks.".format(self.name))
+            location = tips[self.next_tip]
+            self.next_tip += 1
+        self.tip = location
+        self.has_tip = True
+        self._command("pick_up_tip", location.top(), tip_pick_up_time)
+        return self
+
+    def drop_tip(self):
+        self._drop("drop_tip", None)
+        return self
+
+    def return_tip(self):
+        self._drop("return_tip", self.tip.top())
+        return self
+
+    def _drop(self, command, location):
+        if location is None:
+            travel, move_time = self.protocol._move_to(None, TRASH)
+        else:
+            travel, move_time = self.protocol._move_to(location)
+        self.protocol._record(command, pipette=self, location=location, duration=move_time + tip_drop_time, travel=travel)
+        self.has_tip = False
+        self.current_volume = 0
+
+    def reset_tipracks(self):
+        self.next_tip = 0
+
+    def aspirate(self, volume=None, location=None, rate=1.0):
+        if volume is None:
+            volume = self.max_volume - self.current_volume
+        self.current_volume += volume
+        self._command("aspirate", self._location(location, self.well_bottom_clearance.aspirate),
+                      volume / (self.flow_rate.aspirate * rate), volume)
+        return self
+
+    def dispense(self, volume=None, location=None, rate=1.0):
+        if volume is None:
+            volume = self.current_volume
+        self.current_volume = max(0, self.current_volume - volume)
+        self._command("dispense", self._location(location, self.well_bottom_clearance.dispense),
+                      volume / (self.flow_rate.dispense * rate), volume)
+        return self
+
+    def mix(self, repetitions=1, volume=None, location=None, rate=1.0):
+        volume = volume or self.max_volume
+        for _ in range(repetitions):
+            self.aspirate(volume, location, rate)
+            self.dispense(volume, rate=rate)
+        return self
+
+    def blow_out(self, location=None):
+        if isinstance(location, Well):
+            location = location.top()
+        self.current_volume = 0
+        self._command("blow_out", location, blow_out_time)
+        return self
+
+    def touch_tip(self, location=None, **kwargs):
+        if isinstance(location, Well):
+            location = location.top(-1)
+        self._command("touch_tip", location, touch_tip_time)
+        return self
+
+    def air_gap(self, volume=None, height=None):
+        self.aspirate(volume or 0)
+        return self
+
+    def move_to(self, location):
+        self._command("move_to", location)
+        return self
+
+    def _blow_out_to(self, blowout_location, source, dest):
+        if blowout_location == "source well":
+            self.blow_out(_well(source))
+        elif blowout_location == "destination well":
+            self.blow_out(_well(dest))
+        else:
+            self._command("blow_out", None, blow_out_time)
+            self.current_volume = 0
+
+    def transfer(self, volume, source, dest, new_tip="once", touch_tip=False, mix_before=None,
+                 mix_after=None, blow_out=False, blowout_location="trash", **kwargs):
+        """Transfer following the Opentrons rules: lists of sources, destinations and
+        volumes are paired up, and volumes above the max. volume are split in equal parts."""
+        dests = dest if isinstance(dest, list) else [dest]
+        sources = source if isinstance(source, list) else [source] * len(dests)
+        volumes = volume if isinstance(volume, list) else [volume] * len(dests)
+        if new_tip == "once":
+            self.pick_up_tip()
+        for vol, src, dst in zip(volumes, sources, dests):
+            nsteps = -(-vol // self.max_volume)
+            for _ in range(int(nsteps)):
+                if new_tip == "always":
+                    self.pick_up_tip()
+                if mix_before:
+                    self.mix(mix_before[0], mix_before[1], src)
+                self.aspirate(vol / nsteps, src)
+                if touch_tip:
+                    self.touch_tip(_well(src))
+                self.dispense(vol / nsteps, dst)
+                if mix_after:
+                    self.mix(mix_after[0], mix_after[1], dst)
+                if touch_tip:
+                    self.touch_tip(_well(dst))
+                if blow_out:
+                    self._blow_out_to(blowout_location, src, dst)
+                if new_tip == "always":
+                    self.drop_tip()
+        if new_tip == "once":
+            self.drop_tip()
+        return self
+
+    def distribute(self, volume, source, dest, new_tip="once", touch_tip=False, disposal_volume=None,
+                   blow_out=False, blowout_location="trash", **kwargs):
+        """Distribute with as many destinations per aspiration as fit next to the disposal volume."""
+        disposal_volume = self.min_volume if disposal_volume is None else disposal_volume
+        dests = list(dest)
+        wells_pr_fill = max(1, int((self.max_volume - disposal_volume) // volume))
+        if new_tip == "once":
+            self.pick_up_tip()
+        for i in range(0, len(dests), wells_pr_fill):
+            fill = dests[i:i + wells_pr_fill]
+            self.aspirate(volume * len(fill) + disposal_volume, source)
+            if touch_tip:
+                self.touch_tip(_well(source))
+            for well in fill:
+                self.dispense(volume, well)
+                if touch_tip:
+                    self.touch_tip(_well(well))
+            if blow_out or disposal_volume > 0:
+                self._blow_out_to(blowout_location, source, None)
+        if new_tip == "once":
+            self.drop_tip()
+        return self
+
+
+class ProtocolContext:
+    """Recording stand-in for the Opentrons protocol context. The estimated time of
+    the run is kept in time (s), and every command is appended to events."""
+
+    def __init__(self):
+        self.time = 0
+        self.phase = "setup"
+        self.events = []
+        self.deck = {}
+        self.position = None
+
+    def _add_labware(self, labware):
+        if labware.slot in self.deck:
+            raise ValueError("Error: Deck slot {} is already occupied.".format(labware.slot))
+        self.deck[labware.slot] = labware
+        return labware
+
+    def _move_to(self, location, point=None):
+        """Move the gantry in an arc to a location, or to a point outside the labware.
+        Returns the distance travelled in the xy-plane (mm) and the time of the move (s)."""
+        if location is None and point is None:
+            return 0, 0
+        point = location.point if location is not None else point
+        well = location.well if location is not None else None
+        if self.position is None:
+            self.position = (point, well)
+            return 0, 0
+        (start, start_well) = self.position
+        self.position = (point, well)
+        if well is not None and well is start_well:
+            return 0, abs(start[2] - point[2]) / z_speed
+        if well is not None and start_well is not None and well.parent is start_well.parent:
+            height = well.parent.height + well_margin
+        else:
+            height = max([labware.height for labware in self.deck.values()] + [TRASH[2]]) + labware_margin
+        dx, dy = abs(point[0] - start[0]), abs(point[1] - start[1])
+        move_time = (max(0, height - start[2]) + max(0, height - point[2])) / z_speed + max(dx / x_speed, dy / y_speed)
+        return (dx**2 + dy**2) ** 0.5, move_time
+
+    def _record(self, command, pipette=None, location=None, duration=0, volume=None, travel=0):
+        self.events.append({
+            "phase": self.phase,
+            "command": command,
+            "pipette": pipette.name if pipette is not None else None,
+            "volume": volume,
+            "slot": location.well.parent.slot if location is not None else None,
+            "well": location.well.well_name if location is not None else None,
+            "wells": pipette._wells(location) if pipette is not None else [],
+            "start": self.time,
+            "duration": duration,
+            "travel": travel,
+        })
+        self.time += duration
+
+    def load_labware(self, load_name, location, label=None):
+        return self._add_labware(Labware(load_name, location, SLOTS[int(location)]))
+
+    def load_instrument(self, instrument_name, mount, tip_racks=None):
+        return Pipette(self, instrument_name, mount, tip_racks or [])
+
+    def load_module(self, module_name, location):
+        if "temperature" not in module_name.lower():
+            raise ValueError("Error: Module {} is not supported by the simulator.".format(module_name))
+        return TemperatureModule(self, int(location))
+
+    def comment(self, msg):
+        if msg.startswith("Phase: "):
+            self.phase = msg[len("Phase: "):]
+        self._record("comment")
+
+    def pause(self, msg=None):
+        self._record("pause")
+
+    def delay(self, seconds=0, minutes=0, msg=None):
+        self._record("delay", duration=seconds + 60 * minutes)
+
+    def home(self):
+        self.position = None
+
+    def is_simulating(self):
+        return True
+
+    def commands(self):
+        return self.events
+
+
+def load_protocol(path, **overrides):
+    """Import a protocol file as a module. Keyword arguments replace its user inputs."""
+    name = os.path.splitext(os.path.basename(path))[0]
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    for key, value in overrides.items():
+        setattr(module, key, value)
+    return module
+
+
+def code(path):
+    """Tokens of a Python file without comments and blank lines."""
+    with open(path) as f:
+        return " ".join(token.string for token in tokenize.generate_tokens(f.readline)
+                        if token.type not in (tokenize.COMMENT, tokenize.NL))
+
+
+def cache_key(path, overrides):
+    """Content address of a simulated run: the code of the protocol and of the simulator,
+    the replaced user inputs and the version of the labware definitions."""
+    content = json.dumps([code(path), code(__file__), overrides, importlib.metadata.version("opentrons_shared_data")],
+                         sort_keys=True, default=repr)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def read_cache(key):
+    """The cached run of a key, or None. A hit marks the run as recently used."""
+    path = os.path.join(cache_dir, key + ".json")
+    if cache_size == 0 or not os.path.exists(path):
+        return None
+    with open(path) as f:
+        run = json.load(f)
+    os.utime(path)
+    return run
+
+
+def write_cache(key, run):
+    """Store a run in the cache and remove the least recently used runs beyond cache_size."""
+    if cache_size == 0:
+        return
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(os.path.join(cache_dir, key + ".json"), "w") as f:
+        json.dump(run, f)
+    runs = sorted((os.path.join(cache_dir, name) for name in os.listdir(cache_dir) if name.endswith(".json")), key=os.path.getmtime)
+    for path in runs[:-cache_size]:
+        os.remove(path)
+
+
+def simulate(path, **overrides):
+    """Run a protocol against the recording context and return the context, or the cached
+    run of the same content. The helper calls traced by the protocol are kept in
+    trace_calls of the context."""
+    key = cache_key(path, overrides)
+    protocol = ProtocolContext()
+    run = read_cache(key)
+    if run is None:
+        module = load_protocol(path, **overrides)
+        module.run(protocol)
+        run = {"time": protocol.time, "events": protocol.events, "trace_calls": list(getattr(module, "trace_calls", []))}
+        write_cache(key, run)
+    (protocol.time, protocol.events, protocol.trace_calls) = (run["time"], run["events"], run["trace_calls"])
+    return protocol
+
+
+def summarize(protocol):
+    """Summarize the recorded events per phase: time (s), aspirations, dispenses,
+    tips picked up and gantry travel (mm)."""
+    phases = {}
+    for event in protocol.events:
+        phase = phases.setdefault(event["phase"], {"time": 0, "aspirate": 0, "dispense": 0, "tips": 0, "travel": 0})
+        phase["time"] += event["duration"]
+        phase["travel"] += event["travel"]
+        if event["command"] in ("aspirate", "dispense"):
+            phase[event["command"]] += 1
+        elif event["command"] == "pick_up_tip":
+            phase["tips"] += 1
+    total = {key: sum(phase[key] for phase in phases.values()) for key in ("time", "aspirate", "dispense", "tips", "travel")}
+    return {"phases": phases, "total": total}
+
+
+def dna_latency(protocol):
+    """Time (s) from the mastermix is dispensed to a well until the DNA is, for every
+    well that gets both. Wells are given as (slot, well name)."""
+    mastermix = {}
+    latency = {}
+    for event in protocol.events:
+        if event["command"] != "dispense":
+            continue
+        end = event["start"] + event["duration"]
+        for well in [(event["slot"], name) for name in event["wells"]]:
+            if event["phase"] == "mastermix":
+                mastermix.setdefault(well, end)
+            elif event["phase"] == "DNA" and well in mastermix and well not in latency:
+                latency[well] = end - mastermix[well]
+    return latency
+
+
+def traced_calls(protocol):
+    """The traced helper calls with their estimated start and end (s), the number of
+    recorded commands, aspirations and aspirated volume (muL), and the wall time of the
+    simulation (s). Nested calls are included in the counts of their callers."""
+    calls = []
+    for call in protocol.trace_calls:
+        events = protocol.events[call["first_command"]:call["last_command"]]
+        start = protocol.events[call["first_command"]]["start"] if call["first_command"] < len(protocol.events) else protocol.time
+        calls.append({"name": call["name"], "start": start, "end": events[-1]["start"] + events[-1]["duration"] if events else start,
+                      "commands": len(events), "aspirates": sum(event["command"] == "aspirate" for event in events),
+                      "volume": sum(event["volume"] for event in events if event["command"] == "aspirate"),
+                      "wall": call["end"] - call["start"]})
+    return calls
+
+
+def trace_events(protocol, pid=1, name="protocol"):
+    """Chrome trace events of a simulated run: the phases, and the traced helper calls with
+    the recorded commands nested in them, on the estimated time of the run. The helper
+    calls are also given on the wall time of the simulation as a second process."""
+    events = [{"name": "process_name", "ph": "M", "pid": pid, "args": {"name": "{} (estimated time)".format(name)}},
+              {"name": "process_name", "ph": "M", "pid": pid + 1, "args": {"name": "{} (simulation wall time)".format(name)}},
+              {"name": "thread_name", "ph": "M", "pid": pid, "tid": 1, "args": {"name": "phases"}},
+              {"name": "thread_name", "ph": "M", "pid": pid, "tid": 2, "args": {"name": "helpers and commands"}}]
+    phases = []
+    for event in protocol.events:
+        if not phases or phases[-1]["name"] != event["phase"]:
+            phases.append({"name": event["phase"], "start": event["start"]})
+    for phase, following in zip(phases, phases[1:] + [{"start": protocol.time}]):
+        events.append({"name": phase["name"], "cat": "phase", "ph": "X", "pid": pid, "tid": 1,
+                       "ts": phase["start"] * 1e6, "dur": (following["start"] - phase["start"]) * 1e6})
+    wall_start = min([call["start"] for call in protocol.trace_calls], default=0)
+    for call, raw in zip(traced_calls(protocol), protocol.trace_calls):
+        args = {"commands": call["commands"], "aspirates": call["aspirates"], "volume_uL": round(call["volume"], 2)}
+        events.append({"name": call["name"], "cat": "helper", "ph": "X", "pid": pid, "tid": 2, "ts": call["start"] * 1e6,
+                       "dur": (call["end"] - call["start"]) * 1e6, "args": args})
+        events.append({"name": call["name"], "cat": "helper", "ph": "X", "pid": pid + 1, "tid": 1,
+                       "ts": (raw["start"] - wall_start) * 1e6, "dur": call["wall"] * 1e6, "args": args})
+    for event in protocol.events:
+        if event["duration"] > 0:
+            events.append({"name": event["command"], "cat": "command", "ph": "X", "pid": pid, "tid": 2,
+                           "ts": event["start"] * 1e6, "dur": event["duration"] * 1e6,
+                           "args": {"pipette": event["pipette"], "volume": event["volume"], "slot": event["slot"], "well": event["well"]}})
+    return events
+
+
+def helper_summary(protocol):
+    """Calls, aspirations, aspirated volume (muL), estimated time (s) and simulation wall
+    time (s) of each traced helper, summed over its calls."""
+    helpers = {}
+    for call in traced_calls(protocol):
+        row = helpers.setdefault(call["name"], {"calls": 0, "aspirates": 0, "volume": 0, "time": 0, "wall": 0})
+        row["calls"] += 1
+        row["aspirates"] += call["aspirates"]
+        row["volume"] += call["volume"]
+        row["time"] += call["end"] - call["start"]
+        row["wall"] += call["wall"]
+    return helpers
+
+
+def run_log(protocol):
+    """The recorded events as rows of a log, with the start time and duration in s."""
+    return [{"start_s": round(event["start"], 2), "duration_s": round(event["duration"], 2), "phase": event["phase"],
+             "command": event["command"], "pipette": event["pipette"], "volume": event["volume"], "slot": event["slot"],
+             "well": event["well"], "wells": " ".join(event["wells"])} for event in protocol.events]
+
+
+def write_csv(path, rows):
+    """Write a list of dicts to a CSV file, with the keys of all rows as columns."""
+    columns = []
+    for row in rows:
+        columns += [key for key in row if key not in columns]
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, columns)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def print_summary(name, summary):
+    print(name)
+    print("{:<16}{:>12}{:>12}{:>12}{:>8}{:>12}".format("Phase", "Time (min)", "Aspirates", "Dispenses", "Tips", "Travel (m)"))
+    for phase, row in list(summary["phases"].items()) + [("total", summary["total"])]:
+        print("{:<16}{:>12.1f}{:>12}{:>12}{:>8}{:>12.1f}".format(phase, row["time"] / 60, row["aspirate"], row["dispense"], row["tips"], row["travel"] / 1000))
+    latency = list(summary["latency"].values())
+    if latency:
+        print("Mastermix to DNA in {} wells: max. {:.1f} min, mean {:.1f} min, spread {:.1f} min".format(
+            len(latency), max(latency) / 60, sum(latency) / len(latency) / 60, (max(latency) - min(latency)) / 60))
+    print()
+
+
+def print_helpers(helpers):
+    print("{:<44}{:>8}{:>12}{:>14}{:>12}{:>12}".format("Helper", "Calls", "Aspirates", "Volume (uL)", "Time (min)", "Wall (ms)"))
+    for name, row in sorted(helpers.items(), key=lambda item: -item[1]["time"]):
+        print("{:<44}{:>8}{:>12}{:>14.1f}{:>12.1f}{:>12.1f}".format(name, row["calls"], row["aspirates"], row["volume"], row["time"] / 60, row["wall"] * 1000))
+    print()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Estimate the run time of OT-2 protocols.")
+    parser.add_argument("protocols", nargs="+", help="protocol files to simulate")
+    parser.add_argument("--json", help="write the summaries and recorded events to this JSON file")
+    parser.add_argument("--latency", help="write the time from mastermix to DNA of every well to this CSV file")
+    parser.add_argument("--plate-map", help="write the content of every loaded well to this CSV file")
+    parser.add_argument("--log", help="write the recorded events with their start time to this CSV file")
+    parser.add_argument("--trace", help="write the phases, helper calls and commands as a Chrome trace to this JSON file")
+    parser.add_argument("--no-cache", action="store_true", help="simulate the protocols again instead of reading cached runs")
+    args = parser.parse_args()
+    if args.no_cache:
+        cache_size = 0
+
+    results = {}
+    plate_maps = []
+    logs = []
+    trace = []
+    for path in args.protocols:
+        if args.plate_map:
+            plate_maps += [dict(protocol=path, **well) for well in load_protocol(path).plate_map()]
+        protocol = simulate(path)
+        logs += [dict(protocol=path, **row) for row in run_log(protocol)]
+        summary = summarize(protocol)
+        summary["latency"] = dna_latency(protocol)
+        print_summary(path, summary)
+        if args.trace:
+            print_helpers(helper_summary(protocol))
+            trace += trace_events(protocol, pid=2 * len(results) + 1, name=path)
+        summary["latency"] = [{"slot": slot, "well": well, "seconds": seconds} for (slot, well), seconds in summary["latency"].items()]
+        results[path] = {"summary": summary, "events": protocol.events}
+
+    if args.latency:
+        with open(args.latency, "w") as f:
+            f.write("protocol,slot,well,seconds\n")
+            for path, result in results.items():
+                for row in result["summary"]["latency"]:
+                    f.write("{},{},{},{:.1f}\n".format(path, row["slot"], row["well"], row["seconds"]))
+
+    if args.plate_map:
+        write_csv(args.plate_map, plate_maps)
+
+    if args.log:
+        write_csv(args.log, logs)
+
+    if args.trace:
+        with open(args.trace, "w") as f:
+            json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, f)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=1)